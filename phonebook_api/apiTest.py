@@ -1,7 +1,13 @@
+import asyncio
+import io
+import csv
+import json
+import dataclasses
 import pytest
+import main
 from httpx import AsyncClient
 from httpx import ASGITransport
-from main import app
+from main import app, normalize_phone
 from testData import valid_phones, invalid_phones, valid_names, invalid_names
 from testData import valid_phones2, invalid_phones2, valid_names2, invalid_names2
 
@@ -89,3 +95,557 @@ async def test_delete_by_number_invalid(phone):
         headers = {"Authorization": f"Bearer {token}"}
         response = await client.put(f"/PhoneBook/deleteByNumber?phone_number={phone}", headers=headers)
     assert response.status_code in (400, 404), f"Unexpected status for invalid phone number. Response: {response.text}"
+
+@pytest.mark.asyncio
+async def test_list_pagination():
+    token = await get_token("adminuser", "adminpassword")
+    names = ["Ann Marie", "Elon Musk", "Lara Croft"]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        for name in names:
+            await client.post(f"/PhoneBook/add?full_name={name}&phone_number=22.22.22.22", headers=headers)
+
+        # walk every page, ids must keep increasing and no entry is returned twice
+        seen = []
+        cursor = None
+        while True:
+            url = "/PhoneBook/list?limit=2" + (f"&cursor={cursor}" if cursor else "")
+            response = await client.get(url, headers=headers)
+            assert response.status_code == 200, f"Failed to list. Response: {response.text}"
+            page = response.json()
+            assert len(page["items"]) <= 2
+            seen.extend(page["items"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        ids = [item["id"] for item in seen]
+        assert ids == sorted(set(ids))
+        for name in names:
+            assert any(item["full_name"] == name for item in seen)
+
+        for name in names:
+            await client.put(f"/PhoneBook/deleteByName?full_name={name}", headers=headers)
+
+@pytest.mark.asyncio
+async def test_list_field_projection():
+    token = await get_token("readonlyuser", "readonlypassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.get("/PhoneBook/list?fields=full_name", headers=headers)
+        assert response.status_code == 200
+        assert all(set(item) == {"full_name"} for item in response.json()["items"])
+        response = await client.get("/PhoneBook/list?fields=password", headers=headers)
+        assert response.status_code == 400
+        response = await client.get("/PhoneBook/list?cursor=notacursor", headers=headers)
+        assert response.status_code == 400
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("export_format", ["ndjson", "csv"])
+async def test_export_phonebook(export_format):
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/add?full_name=Sherlock Holmes&phone_number=670.123.4567", headers=headers)
+        response = await client.get(f"/PhoneBook/export?format={export_format}", headers=headers)
+        await client.put("/PhoneBook/deleteByName?full_name=Sherlock Holmes", headers=headers)
+    assert response.status_code == 200, f"Failed to export. Response: {response.text}"
+    if export_format == "ndjson":
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert {"full_name": "Sherlock Holmes", "phone_number": "670.123.4567"}.items() <= rows[-1].items()
+    else:
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert rows[-1]["full_name"] == "Sherlock Holmes"
+        assert rows[-1]["phone_number"] == "670.123.4567"
+
+@pytest.mark.asyncio
+async def test_export_requires_login():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/PhoneBook/export")
+    assert response.status_code == 401
+
+@pytest.mark.asyncio
+async def test_phone_number_formats_are_one_number():
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.post("/PhoneBook/add?full_name=Lara Croft&phone_number=670-123-4567", headers=headers)
+        assert response.status_code == 200
+        response = await client.post("/PhoneBook/add?full_name=Lara Croft&phone_number=670.123.4567", headers=headers)
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Person already exists"}
+        response = await client.put("/PhoneBook/deleteByNumber?phone_number=(670)123-4567", headers=headers)
+        assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_bulk_add(monkeypatch):
+    token = await get_token("adminuser", "adminpassword")
+    # the writer only gets people the endpoint already validated
+    written = []
+    add_people = main.add_people
+    def spy_add_people(session, people, validated=False):
+        written.append((people, validated))
+        return add_people(session, people, validated)
+    monkeypatch.setattr(main, "add_people", spy_add_people)
+    people = [
+        {"full_name": "Hugh O'Malley", "phone_number": "670-123-4567"},
+        {"full_name": "L33t Hacker", "phone_number": "670-123-4567"},
+        {"full_name": "Hugh O'Malley", "phone_number": "123"},
+        {"full_name": "Hugh O'Malley", "phone_number": "670.123.4567"},
+        {"full_name": "James O'Shea", "phone_number": "12345"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        assert response.status_code == 200, f"Failed to bulk add. Response: {response.text}"
+        statuses = [result["status"] for result in response.json()["results"]]
+        assert statuses == ["added", "invalid_name", "invalid_phone", "duplicate", "added"]
+        assert response.json()["added"] == 2
+        assert written[0] == ([(people[i]["full_name"], people[i]["phone_number"]) for i in (0, 3, 4)], True)
+
+        # a second run finds both people already stored
+        response = await client.post("/PhoneBook/bulkAdd", json=[people[0], people[4]], headers=headers)
+        assert [result["status"] for result in response.json()["results"]] == ["duplicate", "duplicate"]
+
+        await client.put("/PhoneBook/deleteByName?full_name=Hugh O'Malley", headers=headers)
+        await client.put("/PhoneBook/deleteByName?full_name=James O'Shea", headers=headers)
+
+@pytest.mark.asyncio
+async def test_bulk_add_read_only_user():
+    token = await get_token("readonlyuser", "readonlypassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.post("/PhoneBook/bulkAdd", json=[{"full_name": "Cher", "phone_number": "12345"}], headers=headers)
+    assert response.status_code == 403
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("all_matches, remaining", [(False, 1), (True, 0)])
+async def test_bulk_delete(all_matches, remaining):
+    token = await get_token("adminuser", "adminpassword")
+    people = [
+        {"full_name": "Elizabeth Bennet", "phone_number": "111 111 1111"},
+        {"full_name": "Elizabeth Bennet", "phone_number": "2222.2222"},
+        {"full_name": "Dwayne O'Neil", "phone_number": "12345.12345"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        response = await client.put("/PhoneBook/bulkDelete", json={
+            "full_names": ["Elizabeth Bennet", "L33t Hacker", "Sherlock Holmes"],
+            "phone_numbers": ["12345-12345"],
+            "all_matches": all_matches,
+        }, headers=headers)
+        assert response.status_code == 200, f"Failed to bulk delete. Response: {response.text}"
+        body = response.json()
+        assert body["deleted"] == 3 - remaining
+        assert [result["status"] for result in body["full_names"]] == ["deleted", "invalid_name", "not_found"]
+        assert body["phone_numbers"][0]["status"] == "deleted"
+
+        # the first-match mode leaves the second Elizabeth Bennet behind
+        response = await client.put("/PhoneBook/bulkDelete", json={"full_names": ["Elizabeth Bennet"], "all_matches": True}, headers=headers)
+        assert response.json()["deleted"] == remaining
+
+# A name or number asked for twice deletes once and is counted once
+@pytest.mark.asyncio
+async def test_bulk_delete_repeated_items():
+    token = await get_token("adminuser", "adminpassword")
+    people = [
+        {"full_name": "Repeated Person", "phone_number": "670-321-7654"},
+        {"full_name": "Repeated Person", "phone_number": "670-321-7655"},
+        {"full_name": "Other Person", "phone_number": "670-321-7655"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        response = await client.put("/PhoneBook/bulkDelete", json={
+            "full_names": ["Repeated Person", "Repeated Person"],
+            "phone_numbers": ["670-321-7655", "(670) 321-7655"],
+        }, headers=headers)
+        body = response.json()
+        assert body["deleted"] == 2
+        assert [(r["status"], r["deleted"]) for r in body["full_names"]] == [("deleted", 1), ("duplicate", 0)]
+        assert [(r["status"], r["deleted"]) for r in body["phone_numbers"]] == [("deleted", 1), ("duplicate", 0)]
+        response = await client.put("/PhoneBook/bulkDelete", json={"full_names": ["Repeated Person", "Other Person"], "all_matches": True}, headers=headers)
+        assert response.json()["deleted"] == 1
+
+@pytest.mark.asyncio
+async def test_async_mode(monkeypatch):
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, async_mode=True))
+    token = await get_token("adminuser", "adminpassword")
+    operations = main.write_queue.operations
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            headers = {"Authorization": f"Bearer {token}"}
+            response = await client.post("/PhoneBook/add?full_name=Saoirse Ronan&phone_number=1 670 123 4567", headers=headers)
+            assert response.status_code == 200, f"Failed to add in async mode. Response: {response.text}"
+            # written through the async engine, not the sync writer thread
+            assert main.write_queue.operations == operations
+            response = await client.post("/PhoneBook/add?full_name=Saoirse Ronan&phone_number=1.670.123.4567", headers=headers)
+            assert response.status_code == 400
+            response = await client.get("/PhoneBook/list?limit=1000", headers=headers)
+            assert any(item["full_name"] == "Saoirse Ronan" for item in response.json()["items"])
+            response = await client.get("/PhoneBook/export", headers=headers)
+            assert "Saoirse Ronan" in response.text
+            response = await client.put("/PhoneBook/deleteByName?full_name=Saoirse Ronan", headers=headers)
+            assert response.status_code == 200
+    finally:
+        await main.async_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_validate_endpoint():
+    token = await get_token("readonlyuser", "readonlypassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.post("/PhoneBook/validate", json={
+            "names": ["Bruce Schneier", "L33t Hacker"] * 500,
+            "phone_numbers": ["(703)111-2121", "123"] * 500,
+        }, headers=headers)
+    assert response.status_code == 200, f"Failed to validate. Response: {response.text}"
+    body = response.json()
+    assert [r["valid"] for r in body["names"][:2]] == [True, False]
+    assert body["phone_numbers"][0] == {"value": "(703)111-2121", "valid": True, "normalized": "7031112121"}
+    assert body["phone_numbers"][1] == {"value": "123", "valid": False, "normalized": None}
+    assert len(body["names"]) == len(body["phone_numbers"]) == 1000
+
+@pytest.mark.asyncio
+async def test_search_names():
+    token = await get_token("adminuser", "adminpassword")
+    people = [
+        {"full_name": "Bruce Schneier", "phone_number": "12345"},
+        {"full_name": "Schneier, Bruce Wayne", "phone_number": "12345"},
+        {"full_name": "Bruce Banner", "phone_number": "12345"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        try:
+            response = await client.get("/PhoneBook/search?q=Schneier", headers=headers)
+            assert response.status_code == 200, f"Failed to search. Response: {response.text}"
+            assert {item["full_name"] for item in response.json()["items"]} >= {"Bruce Schneier", "Schneier, Bruce Wayne"}
+            assert "Bruce Banner" not in {item["full_name"] for item in response.json()["items"]}
+
+            response = await client.get("/PhoneBook/search?q=Bruce Sch&limit=1", headers=headers)
+            assert len(response.json()["items"]) == 1
+            assert response.json()["next_offset"] == 1
+
+            response = await client.get("/PhoneBook/search?q=,,,", headers=headers)
+            assert response.status_code == 400
+        finally:
+            await client.put("/PhoneBook/bulkDelete", json={"full_names": [p["full_name"] for p in people], "all_matches": True}, headers=headers)
+        response = await client.get("/PhoneBook/search?q=Schneier", headers=headers)
+        assert "Bruce Schneier" not in {item["full_name"] for item in response.json()["items"]}
+
+# Arabic-Indic and fullwidth digits are the same digits as ASCII ones
+@pytest.mark.asyncio
+async def test_unicode_digit_numbers():
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        for first, second, other in (("٣٣٣-٣٤٥٦", "٤٤٤-٣٤٥٦", "٥٥٥-٣٤٥٦"), ("３３３-３４５７", "４４４-３４５７", "５５５-３４５７")):
+            response = await client.post("/PhoneBook/add", params={"full_name": "Unicode Doe", "phone_number": first}, headers=headers)
+            assert response.status_code == 200, f"Failed to add. Response: {response.text}"
+            response = await client.post("/PhoneBook/add", params={"full_name": "Unicode Doe", "phone_number": second}, headers=headers)
+            assert response.status_code == 200, f"Failed to add. Response: {response.text}"
+            response = await client.post("/PhoneBook/validate", json={"phone_numbers": [first]}, headers=headers)
+            assert response.json()["phone_numbers"][0]["normalized"] == normalize_phone(first) != ""
+
+            response = await client.get("/PhoneBook/lookup", params={"prefix": first[:3]}, headers=headers)
+            assert first in {item["phone_number"] for item in response.json()["items"]}
+            response = await client.get("/PhoneBook/lookup", params={"suffix": first[-4:]}, headers=headers)
+            assert {first, second} <= {item["phone_number"] for item in response.json()["items"]}
+
+            # a number nobody has deletes nothing
+            response = await client.put("/PhoneBook/deleteByNumber", params={"phone_number": other}, headers=headers)
+            assert response.status_code == 404
+            for number in (first, second):
+                response = await client.put("/PhoneBook/deleteByNumber", params={"phone_number": number}, headers=headers)
+                assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_lookup_by_prefix_and_suffix():
+    token = await get_token("adminuser", "adminpassword")
+    people = [
+        {"full_name": "Bruce Schneier", "phone_number": "+1 670 123 4567"},
+        {"full_name": "John Smith", "phone_number": "1-670-999-4567"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        try:
+            response = await client.get("/PhoneBook/lookup", params={"prefix": "+1 670"}, headers=headers)
+            assert response.status_code == 200, f"Failed to look up. Response: {response.text}"
+            assert {"Bruce Schneier", "John Smith"} <= {item["full_name"] for item in response.json()["items"]}
+
+            response = await client.get("/PhoneBook/lookup", params={"prefix": "1670", "suffix": "123-4567"}, headers=headers)
+            assert [item["full_name"] for item in response.json()["items"]] == ["Bruce Schneier"]
+
+            response = await client.get("/PhoneBook/lookup", params={"suffix": "---"}, headers=headers)
+            assert response.status_code == 400
+        finally:
+            await client.put("/PhoneBook/bulkDelete", json={"full_names": [p["full_name"] for p in people], "all_matches": True}, headers=headers)
+        response = await client.get("/PhoneBook/lookup", params={"suffix": "1234567"}, headers=headers)
+        assert "Bruce Schneier" not in {item["full_name"] for item in response.json()["items"]}
+
+@pytest.mark.asyncio
+async def test_list_etag_revalidation():
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        first = await client.get("/PhoneBook/list?limit=5", headers=headers)
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+
+        response = await client.get("/PhoneBook/list?limit=5", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        # a cached page has the same body
+        response = await client.get("/PhoneBook/list?limit=5", headers=headers)
+        assert response.json() == first.json()
+
+        await client.post("/PhoneBook/add?full_name=Etag Person&phone_number=12345", headers=headers)
+        try:
+            response = await client.get("/PhoneBook/list?limit=5", headers={**headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+        finally:
+            await client.put("/PhoneBook/deleteByName?full_name=Etag Person", headers=headers)
+
+@pytest.mark.asyncio
+async def test_list_without_version_counter(monkeypatch):
+    # the database stays the SQLite one, only settings say otherwise
+    main.init_engine()
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, database_url="mysql://db/phonebook"))
+    assert not main.has_version_counter()
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        hits = main.list_cache.stats()["hits"]
+        response = await client.get("/PhoneBook/list?limit=5", headers={**headers, "If-None-Match": '"0", *'})
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+        assert main.list_cache.stats()["hits"] == hits
+
+@pytest.mark.asyncio
+async def test_change_feed_without_change_log(monkeypatch):
+    main.init_engine()
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, database_url="mysql://db/phonebook"))
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/PhoneBook/changes", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 501
+
+@pytest.mark.asyncio
+async def test_change_feed_since_version():
+    token = await get_token("adminuser", "adminpassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        # the newest version, from the last page of the feed
+        since, has_more = 0, True
+        while has_more:
+            response = await client.get("/PhoneBook/changes", params={"since": since, "limit": 1000}, headers=headers)
+            assert response.status_code == 200
+            since, has_more = response.json()["next_since"], response.json()["has_more"]
+
+        await client.post("/PhoneBook/add", params={"full_name": "Changed Person", "phone_number": "12345"}, headers=headers)
+        await client.post("/PhoneBook/add", params={"full_name": "Changed Person", "phone_number": "670-123-4567"}, headers=headers)
+        await client.put("/PhoneBook/deleteByNumber", params={"phone_number": "670.123.4567"}, headers=headers)
+        await client.put("/PhoneBook/deleteByName", params={"full_name": "Changed Person"}, headers=headers)
+
+        response = await client.get("/PhoneBook/changes", params={"since": since, "limit": 3}, headers=headers)
+        body = response.json()
+        assert [(item["op"], item["phone_number"]) for item in body["items"]] == [
+            ("insert", "12345"), ("insert", "670-123-4567"), ("delete", "670-123-4567")]
+        assert body["has_more"] and body["next_since"] == body["items"][-1]["version"]
+        response = await client.get("/PhoneBook/changes", params={"since": body["next_since"]}, headers=headers)
+        assert [(item["op"], item["id"]) for item in response.json()["items"]] == [("delete", body["items"][0]["id"])]
+        assert not response.json()["has_more"]
+
+        response = await client.get("/PhoneBook/changes", params={"since": "latest"}, headers=headers)
+        assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_large_responses_are_gzipped():
+    token = await get_token("adminuser", "adminpassword")
+    people = [{"full_name": f"Gzip Person {chr(65 + i)}a", "phone_number": "12345"} for i in range(26)]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.post("/PhoneBook/bulkAdd", json=people, headers=headers)
+        try:
+            response = await client.get("/PhoneBook/list?limit=1000", headers={**headers, "Accept-Encoding": "gzip"})
+            assert response.status_code == 200
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert {p["full_name"] for p in people} <= {item["full_name"] for item in response.json()["items"]}
+        finally:
+            await client.put("/PhoneBook/bulkDelete", json={"full_names": [p["full_name"] for p in people], "all_matches": True}, headers=headers)
+
+        # small bodies and clients without gzip get plain JSON
+        response = await client.get("/token/stats", headers={**headers, "Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Content-Type"] == "application/json"
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    token = await get_token("readonlyuser", "readonlypassword")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        await client.get("/PhoneBook/list?limit=5", headers=headers)
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        body = response.text
+        assert 'phonebook_http_requests_total{route="/PhoneBook/list",method="GET",status="200"}' in body
+        assert 'phonebook_http_request_duration_seconds_bucket{route="/PhoneBook/list",method="GET",le="+Inf"}' in body
+        assert 'phonebook_sql_statement_duration_seconds_count{statement="SELECT"}' in body
+        assert "phonebook_db_pool_checkout_seconds_count" in body
+        assert "phonebook_password_verify_seconds_count" in body
+        assert "\nphonebook_audit_dropped_records_total " in body
+        # the list requests ran at least the version query
+        statements = next(line for line in body.splitlines() if line.startswith('phonebook_http_request_sql_statements_sum{route="/PhoneBook/list"'))
+        assert float(statements.split()[-1]) > 0
+
+@pytest.mark.asyncio
+async def test_profile_requested_by_write_user(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, profile_dir=str(tmp_path)))
+    profiled_app = main.create_app()
+    admin_token = await get_token("adminuser", "adminpassword")
+    read_token = await get_token("readonlyuser", "readonlypassword")
+    async with AsyncClient(transport=ASGITransport(app=profiled_app), base_url="http://test") as client:
+        response = await client.get("/PhoneBook/list?limit=5", headers={"Authorization": f"Bearer {read_token}", "X-Profile": "1"})
+        assert response.status_code == 200
+        response = await client.get("/PhoneBook/list?limit=5", headers={"Authorization": f"Bearer {admin_token}"})
+        assert list(tmp_path.iterdir()) == []
+
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = await client.post("/PhoneBook/add?full_name=Profiled Person&phone_number=12345&profile=1", headers=headers)
+        assert response.status_code == 200
+        await client.put("/PhoneBook/deleteByName?full_name=Profiled Person", headers=headers)
+
+    summaries = sorted(tmp_path.glob("*.json"))
+    assert len(summaries) == 1
+    assert summaries[0].with_suffix(".prof").exists()
+    summary = json.loads(summaries[0].read_text())
+    assert summary["route"] == "/PhoneBook/add"
+    assert summary["status"] == 200
+    assert {"validator", "database", "other"} <= set(summary["stages"])
+
+@pytest.mark.asyncio
+async def test_concurrent_writes_get_their_own_results():
+    token = await get_token("adminuser", "adminpassword")
+    names = [f"Queued Person {chr(65 + i)}a" for i in range(10)]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        operations = main.write_queue.operations
+        adds = await asyncio.gather(*(
+            client.post("/PhoneBook/add", params={"full_name": name, "phone_number": "12345"}, headers=headers)
+            for name in names + names[:3]
+        ))
+        # each name is added once, its second add is a duplicate even when both land in one batch
+        assert sorted(response.status_code for response in adds) == [200] * 10 + [400] * 3
+        deletes = await asyncio.gather(*(
+            client.put("/PhoneBook/deleteByName", params={"full_name": name}, headers=headers)
+            for name in names + ["Queued Person Missing"]
+        ))
+        assert [response.status_code for response in deletes] == [200] * 10 + [404]
+        assert main.write_queue.operations - operations == 24
+
+@pytest.mark.asyncio
+async def test_sharded_storage(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "settings", dataclasses.replace(
+        main.settings, shard_count=3, shard_url=f"sqlite:///{tmp_path}/shard-{{shard}}.db"))
+    monkeypatch.setattr(main, "shard_store", None)
+    token = await get_token("adminuser", "adminpassword")
+    people = [{"full_name": f"Shard Person {chr(65 + i)}a", "phone_number": f"555 01{i:02d}"} for i in range(12)]
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            headers = {"Authorization": f"Bearer {token}"}
+            response = await client.post("/PhoneBook/bulkAdd", json=people[1:] + [people[1]], headers=headers)
+            assert [result["status"] for result in response.json()["results"]] == ["added"] * 11 + ["duplicate"]
+            response = await client.post("/PhoneBook/add", params=people[0], headers=headers)
+            assert response.status_code == 200
+            response = await client.post("/PhoneBook/add", params={**people[0], "phone_number": "555-0100"}, headers=headers)
+            assert response.status_code == 400
+            # the rows are spread over the shards
+            assert sum(1 for count in await main.shard_store.fan_out(lambda session: session.query(main.PhoneBook).count()) if count) > 1
+
+            # every row once over the pages, in global id order
+            ids, names, cursor = [], [], None
+            while True:
+                response = await client.get("/PhoneBook/list", params={"limit": 5, **({"cursor": cursor} if cursor else {})}, headers=headers)
+                assert response.status_code == 200
+                ids += [item["id"] for item in response.json()["items"]]
+                names += [item["full_name"] for item in response.json()["items"]]
+                cursor = response.json()["next_cursor"]
+                if cursor is None:
+                    break
+            assert ids == sorted(set(ids)) and sorted(names) == sorted(p["full_name"] for p in people)
+            response = await client.get("/PhoneBook/list", params={"cursor": main.encode_cursor(1)}, headers=headers)
+            assert response.status_code == 400
+
+            response = await client.get("/PhoneBook/lookup", params={"prefix": "555010", "limit": 4}, headers=headers)
+            assert [item["phone_number"] for item in response.json()["items"]] == [p["phone_number"] for p in people[:4]]
+            response = await client.get("/PhoneBook/search", params={"q": "shard pers"}, headers=headers)
+            assert len(response.json()["items"]) == 12
+            response = await client.get("/PhoneBook/export", headers=headers)
+            assert sorted(json.loads(line)["id"] for line in response.text.splitlines()) == sorted(ids)
+
+            response = await client.put("/PhoneBook/deleteByNumber", params={"phone_number": "555.0100"}, headers=headers)
+            assert response.status_code == 200
+            response = await client.put("/PhoneBook/deleteByName", params={"full_name": people[1]["full_name"]}, headers=headers)
+            assert response.status_code == 200
+            response = await client.put("/PhoneBook/bulkDelete", json={
+                "full_names": [p["full_name"] for p in people[2:7]],
+                "phone_numbers": [p["phone_number"] for p in people[7:]],
+            }, headers=headers)
+            assert response.json()["deleted"] == 10
+            response = await client.get("/PhoneBook/list", headers=headers)
+            assert response.json()["items"] == []
+
+            # 12 inserts and 12 tombstones, every shard's changes in order
+            changes, since, has_more = [], None, True
+            while has_more:
+                response = await client.get("/PhoneBook/changes", params={"limit": 5, **({"since": since} if since else {})}, headers=headers)
+                changes += response.json()["items"]
+                since, has_more = response.json()["next_since"], response.json()["has_more"]
+            assert sorted(item["op"] for item in changes) == ["delete"] * 12 + ["insert"] * 12
+            assert {item["id"] for item in changes} == set(ids)
+            assert all(
+                [item["op"] for item in changes if item["id"] == person_id] == ["insert", "delete"] for person_id in ids
+            )
+    finally:
+        main.close_shards()
+
+@pytest.mark.asyncio
+async def test_import_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, import_dir=str(tmp_path), import_workers=0))
+    token = await get_token("adminuser", "adminpassword")
+    contacts = "full_name,phone_number\nImported Person Aa,12345\nImported Person Ba,123\nImported Person Ca,670-555-0199\n"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await client.post("/PhoneBook/import", files={"file": ("contacts.csv", contacts, "text/csv")}, headers=headers)
+        assert response.status_code == 202, f"Failed to start the import. Response: {response.text}"
+        import_id = response.json()["id"]
+        for _ in range(100):
+            response = await client.get(f"/PhoneBook/import/{import_id}", headers=headers)
+            if not response.json()["running"]:
+                break
+            await asyncio.sleep(0.02)
+        state = response.json()
+        assert (state["status"], state["records"], state["added"], state["rejected"]) == ("done", 3, 2, 1)
+
+        response = await client.get(f"/PhoneBook/import/{import_id}/rejects", headers=headers)
+        assert list(csv.reader(io.StringIO(response.text)))[1][:4] == ["2", "Imported Person Ba", "123", "invalid_phone"]
+        response = await client.post(f"/PhoneBook/import/{import_id}/resume", headers=headers)
+        assert response.json()["status"] == "done"
+        response = await client.get("/PhoneBook/import/../users", headers=headers)
+        assert response.status_code == 404
+
+        # the upload is gone once done, the checkpoint and rejects when they expire
+        assert not (tmp_path / f"{import_id}.upload").exists()
+        main.expire_imports()
+        assert (await client.get(f"/PhoneBook/import/{import_id}", headers=headers)).status_code == 200
+        monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, import_keep_hours=1e-9))
+        main.expire_imports()
+        assert list(tmp_path.iterdir()) == []
+
+        response = await client.put("/PhoneBook/bulkDelete", json={"full_names": ["Imported Person Aa", "Imported Person Ca"]}, headers=headers)
+        assert response.json()["deleted"] == 2
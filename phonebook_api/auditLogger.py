@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import datetime
+import threading
+
+'''
+Buffered audit logger
+Records are queued by the request path and written by one background thread,
+in batches, so a request never waits on the disk. When the queue is full or
+a batch can't be written (disk full, missing directory), records are dropped
+and counted instead, the writer keeps running and logs the error.
+'''
+
+logger = logging.getLogger(__name__)
+
+class AuditLogger:
+    def __init__(self, path="audit.log", batch_size=100, flush_interval=1.0,
+                 max_bytes=0, backup_count=5, json_format=False, queue_size=10000, on_write=None, on_drop=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # 0 disables rotation, a rotation deletes the oldest backup
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.json_format = json_format
+        # called with the seconds each batch took to write, from the writer thread
+        self.on_write = on_write
+        # called with the number of records lost, from the caller or the writer thread
+        self.on_drop = on_drop
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        # records lost to a full queue or a failed write, and the last write error
+        self.dropped = 0
+        self.last_error = None
+        atexit.register(self.close)
+
+    # Queue one record, the timestamp is taken now and not when it is written
+    def log(self, action, details):
+        self._start()
+        timestamp = datetime.datetime.now().isoformat()
+        try:
+            # never block the caller, it may be the event loop
+            self._queue.put_nowait((timestamp, action, details))
+        except queue.Full:
+            self._drop(1)
+
+    # Block until everything queued so far is on disk
+    def flush(self, timeout=None):
+        if self._thread is None:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    # Write what is left and stop the writer thread, called at shutdown
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        # a live writer drains the queue, so the put gets its turn
+        while thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        thread.join()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _drop(self, count):
+        self.dropped += count
+        if self.on_drop is not None:
+            self.on_drop(count)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-logger", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, tuple):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(pending) < self.batch_size and time.monotonic() < deadline:
+                    continue
+            # batch is full, the interval is over, or a flush/close was asked for
+            if pending:
+                started = time.perf_counter()
+                try:
+                    self._write(pending)
+                    if self.on_write is not None:
+                        self.on_write(time.perf_counter() - started)
+                except Exception as e:
+                    self._drop(len(pending))
+                    self.last_error = str(e)
+                    logger.error("Audit log write to %s failed, dropped %d records: %s", self.path, len(pending), e)
+                pending = []
+            deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+    def _format(self, record):
+        timestamp, action, details = record
+        if self.json_format:
+            return json.dumps({"timestamp": timestamp, "action": action, "details": details}) + "\n"
+        return f"{timestamp} - {action}: {details}\n"
+
+    def _write(self, records):
+        data = "".join(self._format(record) for record in records)
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            if self.max_bytes and self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+        except Exception:
+            # reopened by the next batch, a rotation may have left the file closed
+            if self._file is not None:
+                try:
+                    self._file.close()
+                except OSError:
+                    pass
+                self._file = None
+            raise
+
+    # audit.log -> audit.log.1 -> audit.log.2 ..., the oldest one is dropped
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for number in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{number}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{number + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a")
@@ -0,0 +1,258 @@
+import io
+import os
+import csv
+import sys
+import json
+import argparse
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from validator import validate_name, validate_phone
+
+'''
+Streaming bulk import
+Reads a CSV or NDJSON file of full_name, phone_number records one chunk at a
+time, validates each chunk with the same rules as /PhoneBook/add (in worker
+processes for large files) and hands the valid rows of a chunk to
+write_chunk, which stores them in one transaction and returns add_people's
+results. Only a few chunks are held in memory whatever the file size.
+Rejected records (malformed, invalid, duplicate) are appended to a CSV side
+file. After every chunk a checkpoint with the number of records done is
+written next to it, a new run with the same checkpoint skips what is done and
+truncates the rejects file to where the checkpoint left it. A chunk stored
+just before a crash and before its checkpoint is stored again on resume, the
+duplicate check turns it into duplicates instead of second copies.
+run: `python bulkImport.py contacts.csv` (imports into the database of settings.py)
+'''
+
+IMPORT_FORMATS = ("csv", "ndjson")
+REJECTS_HEADER = ["record", "full_name", "phone_number", "status", "detail"]
+
+# csv or ndjson from the file name, csv when it doesn't say
+def guess_format(filename) -> str:
+    return "ndjson" if str(filename).lower().endswith((".ndjson", ".jsonl", ".json")) else "csv"
+
+# (record, full_name, phone_number, detail) for every record, detail is set for a malformed one.
+# CSV with a header row naming full_name and phone_number takes those columns (an export file works),
+# without one the first two columns.
+def read_records(binary, import_format):
+    text = io.TextIOWrapper(binary, encoding="utf-8-sig", errors="replace", newline="")
+    if import_format == "ndjson":
+        yield from read_ndjson_records(text)
+    else:
+        yield from read_csv_records(text)
+
+def read_csv_records(text):
+    reader = csv.reader(text)
+    first = next(reader, None)
+    if first is None:
+        return
+    header = [column.strip().lower() for column in first]
+    if "full_name" in header and "phone_number" in header:
+        name_column, phone_column, rows = header.index("full_name"), header.index("phone_number"), reader
+    else:
+        name_column, phone_column, rows = 0, 1, _prepend(first, reader)
+    record = 0
+    for row in rows:
+        if not any(value.strip() for value in row):
+            continue
+        record += 1
+        if len(row) <= max(name_column, phone_column):
+            yield record, ",".join(row), "", "Missing a column"
+        else:
+            yield record, row[name_column], row[phone_column], None
+
+def read_ndjson_records(text):
+    record = 0
+    for line in text:
+        if not line.strip():
+            continue
+        record += 1
+        try:
+            value = json.loads(line)
+        except ValueError:
+            yield record, line.strip(), "", "Not a JSON object"
+            continue
+        if not isinstance(value, dict) or not isinstance(value.get("full_name"), str) or not isinstance(value.get("phone_number"), str):
+            yield record, line.strip(), "", "Needs full_name and phone_number strings"
+        else:
+            yield record, value["full_name"], value["phone_number"], None
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
+
+def chunked(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# validate_name and validate_phone come from validator.py, not the app, so worker processes stay light.
+# Returns (record, full_name, phone_number, status, detail), status None for a valid record.
+def validate_chunk(chunk) -> list:
+    checked = []
+    for record, full_name, phone_number, detail in chunk:
+        if detail is not None:
+            checked.append((record, full_name, phone_number, "malformed", detail))
+        elif not validate_name(full_name):
+            checked.append((record, full_name, phone_number, "invalid_name", "Invalid input for name"))
+        elif not validate_phone(phone_number):
+            checked.append((record, full_name, phone_number, "invalid_phone", "Invalid input for phone number"))
+        else:
+            checked.append((record, full_name, phone_number, None, None))
+    return checked
+
+class ImportCancelled(Exception):
+    pass
+
+class BulkImport:
+    # write_chunk(people) stores [(full_name, phone_number)] in one transaction and returns add_people's results.
+    # workers > 0 validates in that many processes once the file is at least parallel_min_bytes.
+    def __init__(self, path, write_chunk, import_format=None, state_path=None, rejects_path=None,
+                 chunk_size=1000, workers=0, parallel_min_bytes=8 * 1024 * 1024, on_progress=None):
+        self.path = str(path)
+        self.write_chunk = write_chunk
+        self.import_format = import_format or guess_format(self.path)
+        if self.import_format not in IMPORT_FORMATS:
+            raise ValueError(f"Unknown import format {self.import_format}")
+        self.state_path = str(state_path or self.path + ".import.json")
+        self.rejects_path = str(rejects_path or self.path + ".rejects.csv")
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.parallel_min_bytes = parallel_min_bytes
+        # called with the state after every chunk
+        self.on_progress = on_progress
+        self._cancel = threading.Event()
+        self.state = self.load_state()
+
+    def new_state(self) -> dict:
+        return {
+            "source": os.path.basename(self.path),
+            "format": self.import_format,
+            "size": os.path.getsize(self.path),
+            "status": "pending",
+            "records": 0,
+            "added": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "rejects_size": 0,
+            "error": None,
+        }
+
+    # The checkpoint of an earlier run of the same file, or a new state
+    def load_state(self) -> dict:
+        state = self.new_state()
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as checkpoint:
+                saved = json.load(checkpoint)
+            if (saved.get("size"), saved.get("format")) != (state["size"], state["format"]):
+                raise ValueError(f"{self.state_path} is the checkpoint of another file")
+            state.update(saved)
+        return state
+
+    # Written to a temporary file and renamed, a crash leaves the old or the new checkpoint
+    def save_state(self):
+        temporary = self.state_path + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump(self.state, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temporary, self.state_path)
+
+    # Stop after the chunk being stored, the checkpoint lets a later run resume
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self) -> dict:
+        if self.state["status"] == "done":
+            return self.state
+        self.state.update(status="running", error=None)
+        self.save_state()
+        try:
+            with open(self.rejects_path, "a+", newline="") as rejects:
+                # rejects written after the last checkpoint are written again
+                rejects.truncate(self.state["rejects_size"])
+                rejects.seek(self.state["rejects_size"])
+                writer = csv.writer(rejects)
+                if self.state["rejects_size"] == 0:
+                    writer.writerow(REJECTS_HEADER)
+                with open(self.path, "rb") as source:
+                    for checked in self.validated_chunks(source):
+                        if self._cancel.is_set():
+                            raise ImportCancelled()
+                        self.store(checked, writer)
+                        rejects.flush()
+                        self.state["rejects_size"] = rejects.tell()
+                        self.save_state()
+                        if self.on_progress is not None:
+                            self.on_progress(dict(self.state))
+            self.state["status"] = "done"
+        except ImportCancelled:
+            self.state["status"] = "interrupted"
+        except Exception as e:
+            self.state.update(status="failed", error=str(e))
+            raise
+        finally:
+            self.save_state()
+        return self.state
+
+    # Validated chunks in file order, the records done by an earlier run are skipped before validation
+    def validated_chunks(self, source):
+        done = self.state["records"]
+        records = (record for record in read_records(source, self.import_format) if record[0] > done)
+        chunks = chunked(records, self.chunk_size)
+        if self.workers <= 0 or self.state["size"] < self.parallel_min_bytes:
+            for chunk in chunks:
+                yield validate_chunk(chunk)
+            return
+        # spawn, the workers only import this module and validator.py
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # a few chunks ahead per worker keeps them busy and the memory bounded
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(validate_chunk, chunk))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+                if self._cancel.is_set():
+                    break
+            while pending:
+                yield pending.popleft().result()
+
+    def store(self, checked, writer):
+        valid = [row for row in checked if row[3] is None]
+        results = self.write_chunk([(full_name, phone_number) for _, full_name, phone_number, _, _ in valid]) if valid else []
+        rejected = [row for row in checked if row[3] is not None]
+        for (record, full_name, phone_number, _, _), result in zip(valid, results):
+            if result["status"] == "added":
+                self.state["added"] += 1
+            else:
+                rejected.append((record, full_name, phone_number, result["status"], result.get("detail", "")))
+        writer.writerows(sorted(rejected))
+        self.state["duplicates"] += sum(1 for row in rejected if row[3] == "duplicate")
+        self.state["rejected"] += len(rejected)
+        self.state["records"] = checked[-1][0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a CSV or NDJSON file of contacts into the phonebook")
+    parser.add_argument("path", help="file with full_name, phone_number records")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="default from the file extension")
+    parser.add_argument("--state", help="checkpoint file, default <path>.import.json, an existing one is resumed")
+    parser.add_argument("--rejects", help="rejected records, default <path>.rejects.csv")
+    parser.add_argument("--chunk-size", type=int, help="records validated and stored together")
+    parser.add_argument("--workers", type=int, help="validation processes for large files, 0 validates in this process")
+    args = parser.parse_args()
+
+    # through the app's write path, into the database of settings.py
+    import main
+    def report(state):
+        print(f"{state['records']} records, {state['added']} added, {state['rejected']} rejected", file=sys.stderr)
+    job = main.new_import(args.path, args.format, args.state, args.rejects, args.chunk_size, args.workers, on_progress=report)
+    state = main.run_import_now(job)
+    print(json.dumps(state, indent=2))
+    sys.exit(0 if state["status"] == "done" else 1)
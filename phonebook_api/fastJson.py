@@ -0,0 +1,24 @@
+import json
+from fastapi.responses import JSONResponse
+
+'''
+Fast JSON
+orjson encodes dicts, lists and plain values in C without the per-object walk
+of json's encoder. When orjson is not installed the stdlib is used with the
+same compact output, so responses are byte for byte the same either way.
+'''
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+# Default response class of the app, FastAPI still runs jsonable_encoder before render
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,61 @@
+import sys
+import gzip
+import json
+import zlib
+import time
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastJson import FastJSONResponse, orjson
+from main import PhoneBook
+from settings import settings
+
+'''
+Encoding benchmark for /PhoneBook/list bodies
+compares FastAPI's default path on ORM PhoneBook objects (jsonable_encoder then
+JSONResponse) with fastJson.dumps on plain row dicts, and the bytes on the wire
+raw, gzipped and deflated at settings.gzip_level
+run: `python listBench.py [rows ...]`, prints JSON, defaults to 10k, 100k and 1M rows
+'''
+
+SIZES = [10000, 100000, 1000000]
+
+def build_rows(count):
+    return [
+        {"id": i, "full_name": f"Schneier, Bruce {i}", "phone_number": f"+1 (703) {i % 1000:03d}-{i % 10000:04d}"}
+        for i in range(1, count + 1)
+    ]
+
+# encode(*args), the arguments are passed in so the caller can drop them right after
+def seconds(encode, *args):
+    start = time.perf_counter()
+    body = encode(*args)
+    return round(time.perf_counter() - start, 4), body
+
+# FastAPI's default path for a list of ORM objects
+def encode_orm(instances):
+    return JSONResponse(jsonable_encoder({"items": instances, "next_cursor": None})).body
+
+def run(sizes=SIZES):
+    results = []
+    for count in sizes:
+        rows = build_rows(count)
+        orm_s, orm_body = seconds(encode_orm, [PhoneBook(**row) for row in rows])
+        fast_s, body = seconds(lambda: FastJSONResponse({"items": rows, "next_cursor": None}).body)
+        assert json.loads(orm_body) == json.loads(body)
+        gzip_s, gzipped = seconds(lambda: gzip.compress(body, settings.gzip_level))
+        deflate_s, deflated = seconds(lambda: zlib.compress(body, settings.gzip_level))
+        results.append({
+            "rows": count,
+            "encoder": "orjson" if orjson is not None else "json",
+            "orm_jsonable_s": orm_s,
+            "fast_json_s": fast_s,
+            "raw_bytes": len(body),
+            "gzip_bytes": len(gzipped),
+            "gzip_s": gzip_s,
+            "deflate_bytes": len(deflated),
+            "deflate_s": deflate_s,
+        })
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run([int(size) for size in sys.argv[1:]] or SIZES), indent=2))
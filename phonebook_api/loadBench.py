@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+import dataclasses
+from collections import deque
+import httpx
+from sqlalchemy import insert
+import main
+from auditLogger import AuditLogger
+
+'''
+Load and latency benchmark for the endpoints
+drives the app in this process through httpx.ASGITransport, or a local uvicorn
+started on a free port, with concurrent clients running a weighted mix of
+requests against a database pre-seeded with --rows entries
+run: `python loadBench.py --transport asgi --rows 0,10000 --concurrency 1,16 --requests 2000`
+prints JSON with throughput and p50/p95/p99 latency, overall and per operation
+'''
+
+DEFAULT_MIX = "list=60,add=15,delete_by_name=10,delete_by_number=10,token=5"
+SEED_CHUNK = 10000
+LOGIN = {"username": "adminuser", "password": "adminpassword"}
+
+# Seeded numbers are (ddd) ddd-dddd, the benchmark adds 5 digit ones, so deletes only hit added rows
+def seed_phone(i):
+    return f"({200 + i % 800}) {i // 800 % 1000:03d}-{i % 10000:04d}"
+
+# Valid unique name for any counter value, "Bench Ab", "Bench Bab", ...
+def bench_name(i):
+    letters = []
+    while True:
+        i, digit = divmod(i, 26)
+        letters.append(chr(97 + digit))
+        if i == 0:
+            break
+    return "Bench Z" + "".join(letters)
+
+def seed_database(path, rows):
+    seeded = main.create_phonebook_engine(dataclasses.replace(main.settings, database_url=f"sqlite:///{path}"))
+    with seeded.begin() as conn:
+        main.init_schema(conn)
+        for start in range(0, rows, SEED_CHUNK):
+            conn.execute(insert(main.PhoneBook), [
+                {"full_name": "Seed" + bench_name(i)[5:], "phone_number": seed_phone(i), "phone_digits": main.normalize_phone(seed_phone(i))}
+                for i in range(start, min(start + SEED_CHUNK, rows))
+            ])
+    seeded.dispose()
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name.strip() not in OPERATIONS:
+            raise SystemExit(f"unknown operation {name!r}, choose from {', '.join(OPERATIONS)}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+# Each operation sends one request and returns its status code
+async def op_list(client, state):
+    return (await client.get("/PhoneBook/list?limit=100", headers=state["headers"])).status_code
+
+async def op_add(client, state):
+    i = next(state["counter"])
+    name, phone = bench_name(i), f"{i % 100000:05d}"
+    response = await client.post("/PhoneBook/add", params={"full_name": name, "phone_number": phone}, headers=state["headers"])
+    if response.status_code == 200:
+        state["added"].append((name, phone))
+    return response.status_code
+
+async def op_delete_by_name(client, state):
+    if not state["added"]:
+        return await op_add(client, state)
+    name, _ = state["added"].popleft()
+    return (await client.put("/PhoneBook/deleteByName", params={"full_name": name}, headers=state["headers"])).status_code
+
+async def op_delete_by_number(client, state):
+    if not state["added"]:
+        return await op_add(client, state)
+    _, phone = state["added"].popleft()
+    return (await client.put("/PhoneBook/deleteByNumber", params={"phone_number": phone}, headers=state["headers"])).status_code
+
+async def op_token(client, state):
+    return (await client.post("/token", data=LOGIN)).status_code
+
+OPERATIONS = {
+    "list": op_list,
+    "add": op_add,
+    "delete_by_name": op_delete_by_name,
+    "delete_by_number": op_delete_by_number,
+    "token": op_token,
+}
+
+def summarize(latencies, statuses, seconds=None):
+    ordered = sorted(latencies)
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 3) if ordered else None
+    summary = {
+        "requests": len(ordered),
+        "errors": sum(1 for code in statuses if code >= 400),
+        "status": {str(code): statuses.count(code) for code in sorted(set(statuses))},
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+    }
+    if seconds is not None:
+        summary["seconds"] = round(seconds, 3)
+        summary["throughput_rps"] = round(len(ordered) / seconds, 1) if seconds else None
+    return summary
+
+# concurrency clients share one request budget, each request picks its operation from the mix
+async def drive(client, weights, concurrency, requests, seed):
+    response = await client.post("/token", data=LOGIN)
+    response.raise_for_status()
+    state = {
+        "headers": {"Authorization": f"Bearer {response.json()['access_token']}"},
+        "counter": itertools.count(),
+        "added": deque(),
+    }
+    names, cumulative = list(weights), list(itertools.accumulate(weights.values()))
+    chooser = random.Random(seed)
+    plan = chooser.choices(names, cum_weights=cumulative, k=requests)
+    results = {name: ([], []) for name in names}
+    queue = deque(plan)
+
+    async def client_loop():
+        while queue:
+            name = queue.popleft()
+            start = time.perf_counter()
+            try:
+                code = await OPERATIONS[name](client, state)
+            except httpx.HTTPError:
+                code = 599
+            results[name][0].append(time.perf_counter() - start)
+            results[name][1].append(code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies = [value for lat, _ in results.values() for value in lat]
+    statuses = [code for _, codes in results.values() for code in codes]
+    return {
+        "overall": summarize(latencies, statuses, seconds),
+        "operations": {name: summarize(*results[name]) for name in names if results[name][0]},
+    }
+
+# The app of main.py on the seeded database, with its lifespan, in this process
+async def run_asgi(path, weights, concurrency, requests, seed):
+    main.settings = dataclasses.replace(main.settings, database_url=f"sqlite:///{path}")
+    main.engine = None
+    main.list_cache.clear()
+    main.token_cache.clear()
+    main.audit_logger = AuditLogger(os.path.join(os.path.dirname(path), "audit.log"))
+    app = main.create_app()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            result = await drive(client, weights, concurrency, requests, seed)
+    main.engine.dispose()
+    return result
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# uvicorn in a child process on the seeded database, audit.log goes to the database's directory
+async def run_uvicorn(path, weights, concurrency, requests, seed, workers=1):
+    port = free_port()
+    env = dict(os.environ, PHONEBOOK_DATABASE_URL=f"sqlite:///{path}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(path), env=env,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for _ in range(300):
+                try:
+                    await client.get("/openapi.json")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn did not start")
+            return await drive(client, weights, concurrency, requests, seed)
+    finally:
+        server.terminate()
+        server.wait(30)
+
+def run(transports, row_counts, concurrencies, requests, mix=DEFAULT_MIX, seed=0, workers=1):
+    weights = parse_mix(mix)
+    results = []
+    for rows in row_counts:
+        for transport in transports:
+            for concurrency in concurrencies:
+                # a fresh copy of the seeded table for every run, writes of one run don't leak into the next
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, "phonebook.db")
+                    seed_database(path, rows)
+                    if transport == "asgi":
+                        result = asyncio.run(run_asgi(path, weights, concurrency, requests, seed))
+                    else:
+                        result = asyncio.run(run_uvicorn(path, weights, concurrency, requests, seed, workers))
+                results.append({"transport": transport, "rows": rows, "concurrency": concurrency, "mix": weights, **result})
+    return results
+
+def int_list(value):
+    return [int(part) for part in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the phonebook API")
+    parser.add_argument("--transport", default="asgi", help="asgi, uvicorn or both, comma separated")
+    parser.add_argument("--rows", type=int_list, default=[0, 10000, 100000], help="seeded table sizes")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 16], help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation=weight list, default {DEFAULT_MIX}")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    transports = [transport.strip() for transport in args.transport.replace("both", "asgi,uvicorn").split(",")]
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "results": run(transports, args.rows, args.concurrency, args.requests, args.mix, args.seed, args.workers),
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,19 +1,55 @@
-from passlib.context import CryptContext
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-fake_users_db = {
-    "readonlyuser": {
-        "username": "readonlyuser",
-        "hashed_password": pwd_context.hash("readonlypassword"),
-        "role": "read",
-        "token": ""
-    },
-    "adminuser": {
-        "username": "adminuser",
-        "hashed_password": pwd_context.hash("adminpassword"),
-        "role": "read/write",
-        "token": ""
+import os
+import json
+import threading
+
+'''
+User store
+Credentials are kept already hashed in users.json (PHONEBOOK_USERS_FILE), so
+nothing is hashed at import. The file is read on the first lookup and indexed
+by username.
+add or update a user: `python loginInfo.py <username> <role>`
+'''
+
+USERS_FILE = os.environ.get("PHONEBOOK_USERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json"))
+
+class UserStore:
+    def __init__(self, path):
+        self.path = path
+        self._users = None
+        self._lock = threading.Lock()
+
+    # username -> user record, read from the file once
+    def load(self) -> dict:
+        if self._users is None:
+            with self._lock:
+                if self._users is None:
+                    with open(self.path) as users_file:
+                        self._users = {user["username"]: user for user in json.load(users_file)}
+        return self._users
+
+    def get(self, username, default=None):
+        return self.load().get(username, default)
+
+    # Drop the index, the file is read again on the next lookup
+    def reload(self):
+        with self._lock:
+            self._users = None
+
+fake_users_db = UserStore(USERS_FILE)
+
+
+if __name__ == "__main__":
+    import sys
+    import getpass
+    from passwordPool import get_pwd_context
+
+    username, role = sys.argv[1], sys.argv[2]
+    users = dict(fake_users_db.load()) if os.path.exists(USERS_FILE) else {}
+    users[username] = {
+        "username": username,
+        "hashed_password": get_pwd_context().hash(getpass.getpass(f"Password for {username}: ")),
+        "role": role,
+        "token": "",
     }
-}
+    with open(USERS_FILE, "w") as users_file:
+        users_file.write(json.dumps(list(users.values()), indent=4) + "\n")
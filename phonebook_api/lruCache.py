@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+'''
+Bounded LRU cache
+Thread-safe map with hit and miss counters, the least recently used entry is
+dropped once max_size is reached. Subclasses override is_fresh to expire
+entries on lookup. Used as is for the serialized /PhoneBook/list pages, whose
+keys start with the phonebook version: a write bumps the version, so entries
+of older versions are never looked up again and age out.
+'''
+
+class LRUCache:
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # False drops the entry on lookup
+    def is_fresh(self, value) -> bool:
+        return True
+
+    # Cached value of the key, None when unknown or no longer fresh
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None or not self.is_fresh(value):
+                if value is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size}
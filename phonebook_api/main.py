@@ -1,18 +1,52 @@
-from fastapi import FastAPI, HTTPException, Depends, status
-from sqlalchemy import create_engine, Column, Integer, String
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile, File, status
+from sqlalchemy import create_engine, event, select, delete, func, and_, or_, inspect, text, bindparam, Column, Index, Integer, String
 #from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.engine import make_url
 import re
+import io
+import os
+import uuid
+import shutil
+import asyncio
+import threading
+import csv
+import json
+import base64
+import dataclasses
+import time
 import datetime
-from jose import JWTError, jwt
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from collections import Counter, namedtuple
+from typing import List, Optional
+from pydantic import BaseModel
 #import jwt
-from passlib.context import CryptContext
+from fastapi.concurrency import run_in_threadpool
+from anyio import from_thread
+from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from loginInfo import fake_users_db
+from auditLogger import AuditLogger
+from settings import settings
+from tokenCache import TokenCache
+from lruCache import LRUCache
+from fastJson import FastJSONResponse, dumps as fast_dumps
+import metrics
+import requestProfiler
+from writeQueue import WriteQueue
+from shardStore import ShardStore
+from bulkImport import BulkImport, guess_format
+from passwordPool import PasswordPool, PasswordPoolBusy
+from validator import phone_scanner, name_scanner, normalize_phone, validate_name, validate_phone
 
 '''
 run: `uvicorn main:app --reload`
+app factory: `uvicorn main:create_app --factory`
+async mode: `PHONEBOOK_ASYNC_MODE=1 uvicorn main:app`, see settings.py
 GO TO THIS ADDRESS FOR UI: http://127.0.0.1:8000/docs
 '''
 
@@ -25,53 +59,32 @@ GO TO THIS ADDRESS FOR UI: http://127.0.0.1:8000/docs
 '''
 SETUP FOR USERBASE
 SETUP FOR LOGIN SECURITY ALGO
-SETUP FOR REGEX
 '''
 
 # JWT Configuration for login only 
 SECRET_KEY = "mysecretkey123"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto") 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token") 
+# Tokens that passed jwt.decode, with their user, until the token expires
+token_cache = TokenCache(settings.token_cache_size)
 
-app = FastAPI() 
-
-
-
-
-phone_regex = re.compile(r"""
-    ^                                          # Start of string
-    ((\d{5}|                                   # 12345 
-        
-    \d{5}[-.\s]\d{5})|                         # 12345.12345
-        
-    (\d{3}[-.\s]\d{4})|                        # 123-4567
-        
-    (\+?[1-9]\d{0,2})?                      
-        (\s?\(?[1-9]\d{1,2}\)?[-.\s]?)     
-            (\d{3}[-.\s]\d{4})|                 
-        
-    ((\+?\d{1,3})[-.\s]\d{1,3}[-.\s]\d{3}[-.\s]\d{3}[-.\s]\d{4}$)|      # +1 234 567 8901
-    
-    (\d{4}[-.\s]\d{4})|                                                 # 1234 5678   
-                 
-    (\d{2}[-.\s]\d{2}[-.\s]\d{2}[-.\s]\d{2})|                           # 22 22 22 22
-    
-    ((\+?\d{1,3})[-.\s]\d{3}[-.\s]\d{3}[-.\s]\d{4})                     # +1 123 456 7890
-    )$""", re.VERBOSE)
-
-
-name_regex = re.compile(r"""
-    ^                                  
-    [a-zA-Z]([-'’\.])?[a-zA-Z]+?    
-                        
-    (([-'’\.])?,?\s[A-Z]([-'’\.])?[a-zA-Z]+(([\s -])?[A-Z][a-zA-Z]+)?)? 
-                 
-    (([-'’\.])?,?\s[A-Z]\.(\s[A-Z]([-'’\.])?[a-zA-Z]+(-[A-Z][a-zA-Z]+)?)?)?           
-    $                                  
-""", re.VERBOSE | re.UNICODE)
+# Audit records are written in batches by a background thread, records it loses are counted in /metrics
+audit_logger = AuditLogger(
+    settings.audit_path,
+    max_bytes=settings.audit_max_bytes,
+    backup_count=settings.audit_backups,
+    json_format=settings.audit_json,
+    on_write=metrics.AUDIT_WRITE_SECONDS.observe,
+    on_drop=lambda count: metrics.AUDIT_DROPPED.inc(amount=count),
+)
+# bcrypt at /token runs in worker processes, see passwordPool.py
+password_pool = PasswordPool(settings.password_workers, settings.password_max_pending)
+# Serialized /PhoneBook/list pages, keyed by the phonebook version
+list_cache = LRUCache(settings.list_cache_size)
 
+# Endpoints are registered on the router, create_app builds the app around it
+router = APIRouter()
 
 
 #########################################
@@ -84,10 +97,14 @@ DATABASE SETUP
 PHONEBOOK MODEL
 '''
 
-# SQLite database setup
-engine = create_engine("sqlite:///phonebook.db", echo=True)
+# Database url and async mode come from settings.py, engines are created on first use
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
+AsyncSession = None
+engine = None
+async_engine = None
+_engine_lock = threading.Lock()
+_async_engine_lock = asyncio.Lock()
 
 # PhoneBook model
 class PhoneBook(Base):
@@ -95,7 +112,379 @@ class PhoneBook(Base):
     id = Column(Integer, primary_key=True)
     full_name = Column(String)
     phone_number = Column(String)
-Base.metadata.create_all(engine)
+    # normalized phone_number, used for lookups and the duplicate check
+    phone_digits = Column(String)
+    # phone_digits backwards, a suffix lookup is a range scan on its index
+    phone_digits_reversed = Column(String, default=lambda context: reverse_digits(context.get_current_parameters()["phone_digits"]))
+
+    __table_args__ = (
+        # one person per name and number, inserts rely on it with ON CONFLICT DO NOTHING
+        Index("uq_phonebook_full_name_phone_digits", "full_name", "phone_digits", unique=True),
+        Index("ix_phonebook_phone_digits", "phone_digits"),
+        Index("ix_phonebook_phone_digits_reversed", "phone_digits_reversed"),
+    )
+
+def reverse_digits(digits):
+    return None if digits is None else digits[::-1]
+
+# One row counting writes to phonebook, bumped by triggers in the writer's transaction.
+# Every uvicorn worker reads the same row, so their list caches agree.
+class PhoneBookVersion(Base):
+    __tablename__ = "phonebook_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# Triggers of the databases that have them, the list cache and ETags are off on the others
+VERSION_TRIGGER_DDL = {
+    "sqlite": [
+        f"""CREATE TRIGGER IF NOT EXISTS phonebook_version_{event} AFTER {event.upper()} ON phonebook BEGIN
+            UPDATE phonebook_version SET version = version + 1 WHERE id = 1;
+        END"""
+        for event in ("insert", "update", "delete")
+    ],
+    "postgresql": [
+        """CREATE OR REPLACE FUNCTION phonebook_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE phonebook_version SET version = version + 1 WHERE id = 1;
+            RETURN NULL;
+        END $$""",
+        "DROP TRIGGER IF EXISTS phonebook_version ON phonebook",
+        """CREATE TRIGGER phonebook_version AFTER INSERT OR UPDATE OR DELETE ON phonebook
+            FOR EACH ROW EXECUTE FUNCTION phonebook_version_bump()""",
+    ],
+}
+
+# Change feed, one row per insert and one tombstone per delete, written by triggers.
+# version never goes back, AUTOINCREMENT keeps SQLite from reusing it.
+class PhoneBookChange(Base):
+    __tablename__ = "phonebook_changes"
+    version = Column(Integer, primary_key=True)
+    # "insert" or "delete"
+    op = Column(String, nullable=False)
+    person_id = Column(Integer, nullable=False)
+    full_name = Column(String)
+    phone_number = Column(String)
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+# Rows a migration removed because they repeat an earlier name and number, kept to be checked by hand.
+# id is the row's id in phonebook, kept_id the id of the row that stayed.
+# Not in Base's metadata, remove_duplicates creates it in the databases that need it.
+MigrationBase = declarative_base()
+
+class PhoneBookDuplicate(MigrationBase):
+    __tablename__ = "phonebook_duplicates"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    kept_id = Column(Integer, nullable=False)
+    full_name = Column(String)
+    phone_number = Column(String)
+
+# An update is logged as the delete of the old row and the insert of the new one.
+# Triggers of the databases that have them, /PhoneBook/changes answers 501 on the others.
+CHANGE_TRIGGER_DDL = {
+    "sqlite": [
+        """CREATE TRIGGER IF NOT EXISTS phonebook_changes_insert AFTER INSERT ON phonebook BEGIN
+            INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('insert', new.id, new.full_name, new.phone_number);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS phonebook_changes_delete AFTER DELETE ON phonebook BEGIN
+            INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('delete', old.id, old.full_name, old.phone_number);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS phonebook_changes_update AFTER UPDATE ON phonebook BEGIN
+            INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('delete', old.id, old.full_name, old.phone_number);
+            INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('insert', new.id, new.full_name, new.phone_number);
+        END""",
+    ],
+    # Writers take the same transaction lock before drawing a version, so versions commit in order
+    # and a reader never sees a version before a lower one has committed. SQLite has one writer anyway.
+    "postgresql": [
+        """CREATE OR REPLACE FUNCTION phonebook_changes_log() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('phonebook_changes'));
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('delete', OLD.id, OLD.full_name, OLD.phone_number);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) VALUES ('insert', NEW.id, NEW.full_name, NEW.phone_number);
+            END IF;
+            RETURN NULL;
+        END $$""",
+        "DROP TRIGGER IF EXISTS phonebook_changes_insert ON phonebook",
+        """CREATE TRIGGER phonebook_changes_insert AFTER INSERT OR UPDATE OR DELETE ON phonebook
+            FOR EACH ROW EXECUTE FUNCTION phonebook_changes_log()""",
+    ],
+}
+TRIGGER_EXISTS_SQL = {
+    "sqlite": "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name",
+    "postgresql": "SELECT 1 FROM pg_trigger WHERE tgname = :name",
+}
+
+# Rows backfilled per statement when migrating an existing database
+MIGRATION_BATCH_SIZE = 10000
+# Duplicates named in the error of a migration that stops on them
+MIGRATION_DUPLICATES_SHOWN = 20
+
+# Rows repeating the name and number of a row with a lower id, as (id, kept_id, full_name, phone_number)
+def find_duplicates(conn) -> list:
+    phonebook_table = PhoneBook.__table__
+    first = (
+        select(func.min(phonebook_table.c.id).label("kept_id"), phonebook_table.c.full_name, phonebook_table.c.phone_digits)
+        .group_by(phonebook_table.c.full_name, phonebook_table.c.phone_digits)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    return conn.execute(
+        select(phonebook_table.c.id, first.c.kept_id, phonebook_table.c.full_name, phonebook_table.c.phone_number)
+        .join(first, and_(phonebook_table.c.full_name == first.c.full_name, phonebook_table.c.phone_digits == first.c.phone_digits))
+        .where(phonebook_table.c.id != first.c.kept_id)
+        .order_by(phonebook_table.c.id)
+    ).all()
+
+# Stop with the rows listed, or move them to phonebook_duplicates when settings allow it
+def remove_duplicates(conn):
+    duplicates = find_duplicates(conn)
+    if not duplicates:
+        return
+    if not settings.migrate_remove_duplicates:
+        shown = "; ".join(
+            f"id {row.id} {row.full_name!r} {row.phone_number!r} repeats id {row.kept_id}"
+            for row in duplicates[:MIGRATION_DUPLICATES_SHOWN]
+        )
+        more = f" and {len(duplicates) - MIGRATION_DUPLICATES_SHOWN} more" if len(duplicates) > MIGRATION_DUPLICATES_SHOWN else ""
+        raise ValueError(
+            f"{len(duplicates)} phonebook rows repeat an earlier name and number, the unique index can't be built: "
+            f"{shown}{more}. Remove them, or set PHONEBOOK_MIGRATE_REMOVE_DUPLICATES=1 to move them to phonebook_duplicates"
+        )
+    duplicates_table = PhoneBookDuplicate.__table__
+    duplicates_table.create(conn, checkfirst=True)
+    conn.execute(duplicates_table.insert(), [row._asdict() for row in duplicates])
+    for start in range(0, len(duplicates), MIGRATION_BATCH_SIZE):
+        ids = [row.id for row in duplicates[start:start + MIGRATION_BATCH_SIZE]]
+        conn.execute(delete(PhoneBook.__table__).where(PhoneBook.__table__.c.id.in_(ids)))
+    for row in duplicates:
+        log_action("Migration moved a duplicate", f"id {row.id}, {row.full_name}, {row.phone_number}, same as id {row.kept_id}")
+
+# Bring a phonebook.db created by an older version up to the current model, inside conn's transaction
+def migrate_phonebook(conn):
+    phonebook_table = PhoneBook.__table__
+    columns = {column["name"] for column in inspect(conn).get_columns("phonebook")}
+    for column in ("phone_digits", "phone_digits_reversed"):
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE phonebook ADD COLUMN {column} VARCHAR"))
+    # backfill the normalized numbers for rows written before the columns existed
+    backfill = (
+        phonebook_table.update()
+        .where(phonebook_table.c.id == bindparam("row_id"))
+        .values(phone_digits=bindparam("digits"), phone_digits_reversed=bindparam("reversed_digits"))
+    )
+    while True:
+        rows = conn.execute(
+            select(phonebook_table.c.id, phonebook_table.c.phone_number)
+            .where(or_(phonebook_table.c.phone_digits.is_(None), phonebook_table.c.phone_digits_reversed.is_(None)))
+            .limit(MIGRATION_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        digits = [normalize_phone(row.phone_number or "") for row in rows]
+        conn.execute(backfill, [
+            {"row_id": row.id, "digits": number, "reversed_digits": reverse_digits(number)}
+            for row, number in zip(rows, digits)
+        ])
+    # numbers in non-ASCII digits were once normalized to "", one pass in id order gives them their digits
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(phonebook_table.c.id, phonebook_table.c.phone_number)
+            .where(phonebook_table.c.phone_digits == "", phonebook_table.c.id > last_id)
+            .order_by(phonebook_table.c.id)
+            .limit(MIGRATION_BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        digits = [normalize_phone(row.phone_number or "") for row in rows]
+        conn.execute(backfill, [
+            {"row_id": row.id, "digits": number, "reversed_digits": reverse_digits(number)}
+            for row, number in zip(rows, digits)
+        ])
+        last_id = rows[-1].id
+    indexes = {index["name"] for index in inspect(conn).get_indexes("phonebook")}
+    if "uq_phonebook_full_name_phone_digits" not in indexes:
+        # the unique index can't be built over a name and number stored twice
+        remove_duplicates(conn)
+        # the plain index it replaces
+        conn.execute(text("DROP INDEX IF EXISTS ix_phonebook_full_name_phone_digits"))
+    for index in phonebook_table.indexes:
+        index.create(conn, checkfirst=True)
+
+# Create missing tables and migrate old ones
+def init_schema(conn):
+    Base.metadata.create_all(conn)
+    migrate_phonebook(conn)
+    create_name_index(conn)
+    create_lookup_indexes(conn)
+    create_version_counter(conn)
+    create_change_log(conn)
+
+# The version row and, on SQLite, the triggers that bump it
+def create_version_counter(conn):
+    version_table = PhoneBookVersion.__table__
+    if conn.execute(select(version_table.c.id).where(version_table.c.id == 1)).first() is None:
+        conn.execute(version_table.insert().values(id=1, version=0))
+    for statement in VERSION_TRIGGER_DDL.get(conn.dialect.name, []):
+        conn.execute(text(statement))
+
+# The change triggers. Rows stored before them are logged as inserts once,
+# so a client reading the feed from 0 sees the whole phonebook.
+def create_change_log(conn):
+    if conn.dialect.name not in CHANGE_TRIGGER_DDL:
+        return
+    exists = conn.execute(text(TRIGGER_EXISTS_SQL[conn.dialect.name]), {"name": "phonebook_changes_insert"}).first()
+    if not exists:
+        conn.execute(text(
+            "INSERT INTO phonebook_changes(op, person_id, full_name, phone_number) "
+            "SELECT 'insert', id, full_name, phone_number FROM phonebook ORDER BY id"
+        ))
+    for statement in CHANGE_TRIGGER_DDL[conn.dialect.name]:
+        conn.execute(text(statement))
+
+# Journal and synchronous modes are keywords, the other pragmas are numbers
+sqlite_pragma_value = re.compile(r'^-?[A-Za-z0-9]+$')
+
+# Apply the configured pragmas on every new SQLite connection of the engine
+def configure_sqlite(sync_engine, pragmas):
+    if sync_engine.dialect.name != "sqlite":
+        return
+    for name, value in pragmas.items():
+        if not sqlite_pragma_value.match(str(value)):
+            raise ValueError(f"Invalid value for SQLite pragma {name}: {value}")
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+# Sync engine with the pool options and pragmas from settings
+def create_phonebook_engine(settings):
+    new_engine = create_engine(settings.database_url, **settings.engine_options)
+    configure_sqlite(new_engine, settings.sqlite_pragmas)
+    metrics.instrument_engine(new_engine)
+    return new_engine
+
+# Sync engine, created and migrated on first use
+def init_engine():
+    global engine
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                new_engine = create_phonebook_engine(settings)
+                with new_engine.begin() as conn:
+                    init_schema(conn)
+                Session.configure(bind=new_engine)
+                engine = new_engine
+    return engine
+
+# Async engine for the async mode, created and migrated on first use.
+# sqlalchemy.ext.asyncio needs greenlet and an async driver, so it is only imported here.
+async def init_async_engine():
+    global async_engine, AsyncSession
+    if async_engine is None:
+        async with _async_engine_lock:
+            if async_engine is None:
+                from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+                new_engine = create_async_engine(settings.async_database_url, **settings.engine_options)
+                configure_sqlite(new_engine.sync_engine, settings.sqlite_pragmas)
+                metrics.instrument_engine(new_engine.sync_engine)
+                async with new_engine.begin() as conn:
+                    await conn.run_sync(init_schema)
+                AsyncSession = async_sessionmaker(new_engine, expire_on_commit=False)
+                async_engine = new_engine
+    return async_engine
+
+# Run fn(session, *args) in a session of its own on the sync engine
+def run_in_session(fn, *args, commit=False):
+    init_engine()
+    session = Session()
+    try:
+        with requestProfiler.stage("database"):
+            # take the connection first, so the wait for the pool is measured on its own
+            started = time.perf_counter()
+            session.connection()
+            metrics.POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+            result = fn(session, *args)
+            if commit:
+                session.commit()
+            return result
+    finally:
+        session.close()
+
+# Run fn(session, *args) on the configured engine. The sync engine runs it in the worker threadpool,
+# the async mode runs it on the event loop through AsyncSession.run_sync, so both share the same queries.
+async def run_db(fn, *args, commit=False):
+    if not settings.async_mode:
+        return await run_in_threadpool(run_in_session, fn, *args, commit=commit)
+    await init_async_engine()
+    async with AsyncSession() as session:
+        with requestProfiler.stage("database"):
+            started = time.perf_counter()
+            await session.connection()
+            metrics.POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+            result = await session.run_sync(fn, *args)
+            if commit:
+                await session.commit()
+            return result
+
+# Writes go through one writer thread that commits them in batches, see writeQueue.py
+def new_write_session():
+    init_engine()
+    return Session()
+
+def run_write_op(session, fn, *args):
+    with requestProfiler.stage("database"):
+        return fn(session, *args)
+
+write_queue = WriteQueue(
+    new_write_session,
+    window=settings.write_window_ms / 1000,
+    max_batch=settings.write_max_batch,
+    on_batch=metrics.WRITE_BATCH_SIZE.observe,
+)
+
+# Run a write fn(session, *args) and commit it, through the write queue unless it is turned off.
+# The queue's writer thread uses the sync engine, so the async mode writes through the AsyncSession instead.
+async def run_write(fn, *args):
+    if settings.write_queue and not settings.async_mode:
+        return await write_queue.run(run_write_op, fn, *args)
+    return await run_db(fn, *args, commit=True)
+
+# INSERT ... ON CONFLICT DO NOTHING on the unique name and number, the dialects that have it
+CONFLICT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+def insert_new_people(session):
+    conflict_insert = CONFLICT_INSERTS[session.get_bind().dialect.name]
+    return conflict_insert(PhoneBook).on_conflict_do_nothing(index_elements=["full_name", "phone_digits"])
+
+# Add one person unless the same name and number is stored, returns False for a duplicate.
+# One statement, the unique index decides, so two workers can't both add the same person.
+def insert_person(session, full_name, phone_number, phone_digits) -> bool:
+    added = session.execute(
+        insert_new_people(session)
+        .values(full_name=full_name, phone_number=phone_number, phone_digits=phone_digits, phone_digits_reversed=reverse_digits(phone_digits))
+        .returning(PhoneBook.id)
+    ).first()
+    return added is not None
+
+# Delete the first person (lowest id) where column == value in one statement,
+# returns (full_name, phone_number) or None
+def delete_first_person(session, column, value):
+    first_id = select(PhoneBook.id).where(column == value).order_by(PhoneBook.id).limit(1).scalar_subquery()
+    person = session.execute(
+        delete(PhoneBook)
+        .where(PhoneBook.id == first_id)
+        .returning(PhoneBook.full_name, PhoneBook.phone_number)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return tuple(person) if person else None
 
 
 #########################################
@@ -108,44 +497,56 @@ LOGGING FUNCTION
 LOGIN PROCCESSING AND TOKENS
 '''
 
-# Logging actions
+# Logging actions, queued and written off the request path
 def log_action(action, details):
-    timestamp = datetime.datetime.now().isoformat()
-    with open("audit.log", "a") as log_file:
-        log_file.write(f"{timestamp} - {action}: {details}\n")
+    audit_logger.log(action, details)
 
-# JWT token creation
+# JWT token creation, valid for ACCESS_TOKEN_EXPIRE_MINUTES
 def create_access_token(data: dict):
-    return jwt.encode(data, SECRET_KEY, algorithm=ALGORITHM)
-
-# Password verification
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    from jose import jwt
+    expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return jwt.encode({**data, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
 
 # Get user from database
 def get_user(db, username: str):
     user = db.get(username)
     return user if user else None
 
-# Get current user 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+# Verify the token and look up its user, both are skipped while the token is cached
+def resolve_token(token: str):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+    from jose import JWTError, jwt
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-        return username
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-
-
-# Get current active user
-def get_current_active_user(current_user: str = Depends(get_current_user)):
-    user = get_user(fake_users_db, current_user)
+    username: str = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    user = get_user(fake_users_db, username)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid user")
+    # a token without exp never expires, so it is verified every time
+    if isinstance(payload.get("exp"), (int, float)):
+        token_cache.put(token, user, payload["exp"])
     return user
 
+# Profiles are written for write users only, see requestProfiler.py
+def profile_authorized(headers) -> bool:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        return resolve_token(token)["role"] == "read/write"
+    except HTTPException:
+        return False
+
+# Get current active user, the token and its user are both checked in resolve_token
+async def get_current_active_user(token: str = Depends(oauth2_scheme)):
+    return resolve_token(token)
+
 
 
 #########################################
@@ -159,36 +560,861 @@ REGEX INPUT VALIDATION
 '''
 
 # Authorization for read access
-def authorize_read(user: dict = Depends(get_current_active_user)):
+async def authorize_read(user: dict = Depends(get_current_active_user)):
     if user["role"] not in ["read", "read/write"]:
         log_action("Try to list without privileges","Attempt to access data without priviledges")
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient privileges")
     return user
 
 # Authorization for write access
-def authorize_write(user: dict = Depends(get_current_active_user)):
+async def authorize_write(user: dict = Depends(get_current_active_user)):
     if user["role"] != "read/write":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient privileges")
     return user
 
-# Validate name, need to verify only, leave the exception for endpoint
-def validate_name(name) -> bool:
-    if not name_regex.match(name):
-        return False
-    if len(name) > 50:
-        return False
-    return True
+# Memoized verdicts, the same values repeat a lot in imports
+@lru_cache(maxsize=settings.validation_cache_size)
+def cached_name_verdict(name) -> bool:
+    return validate_name(name)
 
-# Validate phone, need to verify only, leave the exception for endpoint
-def validate_phone(phone) -> bool:
-    # Remove all non-digit characters
-    cleaned_phone = re.sub(r'[^0-9]', '', phone)  
-    if not phone_regex.match(phone):
-        return False
-    # Limit length to 15 digits
-    if len(cleaned_phone) > 15:                   
+@lru_cache(maxsize=settings.validation_cache_size)
+def cached_phone_verdict(phone):
+    return normalize_phone(phone) if validate_phone(phone) else None
+
+# Validate many names and phones at once, phones that pass come back in their normalized digit form.
+# Values too long to ever be valid are rejected without going into the caches.
+def validate_batch(names, phones) -> dict:
+    with requestProfiler.stage("validator"):
+        return {
+            "names": [
+                {"value": name, "valid": len(name) <= name_scanner.max_length and cached_name_verdict(name)}
+                for name in names
+            ],
+            "phone_numbers": [
+                {"value": phone, "valid": digits is not None, "normalized": digits}
+                for phone, digits in (
+                    (phone, cached_phone_verdict(phone) if len(phone) <= phone_scanner.max_length else None)
+                    for phone in phones
+                )
+            ],
+        }
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+LIST PAGINATION
+KEYSET CURSOR AND FIELD PROJECTION
+'''
+
+# Page size for /PhoneBook/list, a page is always bounded
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+LIST_FIELDS = ("id", "full_name", "phone_number")
+
+# Cursor is opaque to the client, it only carries the last id of the previous page
+def encode_cursor(last_id: int) -> str:
+    raw = json.dumps({"id": last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded.encode()))["id"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    if not isinstance(last_id, int):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return last_id
+
+# Comma separated field list, default is every field
+def parse_fields(fields: Optional[str]) -> tuple:
+    if not fields:
+        return LIST_FIELDS
+    requested = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in requested if f not in LIST_FIELDS]
+    if unknown or not requested:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid fields: {', '.join(unknown)}")
+    return requested
+
+# Backend of the configured database, sqlite, postgresql, ...
+def database_backend() -> str:
+    url = settings.shard_urls[0] if settings.shard_count else settings.database_url
+    return make_url(url).get_backend_name()
+
+# Whether the configured database keeps the version counter up to date
+def has_version_counter() -> bool:
+    return database_backend() in VERSION_TRIGGER_DDL
+
+def read_version(session) -> int:
+    return session.execute(select(PhoneBookVersion.version).where(PhoneBookVersion.id == 1)).scalar_one()
+
+# Page and version read in one transaction, so the page is the one the version names
+def fetch_versioned_page(session, after_id, limit, selected):
+    version = read_version(session)
+    return version, fetch_page(session, after_id, limit, selected)
+
+# Strong ETag of a phonebook version, every list page of that version shares it
+def list_etag(version: int) -> str:
+    return f'"{version}"'
+
+# If-None-Match holds "*" or a comma separated list of tags, weak ones compare equal
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
         return False
-    return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+# One page of rows after after_id, plus one extra row that tells if there is a next page
+def fetch_page(session, after_id, limit, selected):
+    # id is always selected, the next cursor is built from it
+    columns = [PhoneBook.id] + [getattr(PhoneBook, f) for f in selected if f != "id"]
+    return (
+        session.query(*columns)
+        .filter(PhoneBook.id > after_id)
+        .order_by(PhoneBook.id)
+        .limit(limit + 1)
+        .all()
+    )
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+NAME SEARCH
+FTS5 INDEX ON full_name
+'''
+
+# External-content FTS5 table over phonebook.full_name, kept in sync by triggers so
+# every write path (ORM, bulk insert, DELETE ... RETURNING) updates it in the same transaction.
+# unicode61 splits on punctuation, "Schneier, Bruce" and "O’Malley" become schneier/bruce and o/malley.
+NAME_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS phonebook_fts USING fts5(
+        full_name, content='phonebook', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS phonebook_fts_insert AFTER INSERT ON phonebook BEGIN
+        INSERT INTO phonebook_fts(rowid, full_name) VALUES (new.id, new.full_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS phonebook_fts_delete AFTER DELETE ON phonebook BEGIN
+        INSERT INTO phonebook_fts(phonebook_fts, rowid, full_name) VALUES ('delete', old.id, old.full_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS phonebook_fts_update AFTER UPDATE OF full_name ON phonebook BEGIN
+        INSERT INTO phonebook_fts(phonebook_fts, rowid, full_name) VALUES ('delete', old.id, old.full_name);
+        INSERT INTO phonebook_fts(rowid, full_name) VALUES (new.id, new.full_name);
+    END""",
+]
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_TOKENS = 8
+# Same split as the unicode61 tokenizer: letters and digits, everything else separates
+search_token_regex = re.compile(r'[^\W_]+')
+
+# Create the name index on SQLite, filled from the existing rows the first time
+def create_name_index(conn):
+    if conn.dialect.name != "sqlite":
+        return
+    exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'phonebook_fts'")).first()
+    for statement in NAME_INDEX_DDL:
+        conn.execute(text(statement))
+    if not exists:
+        conn.execute(text("INSERT INTO phonebook_fts(phonebook_fts) VALUES ('rebuild')"))
+
+# Search terms of a query, each one is matched as a prefix
+def search_tokens(query: str) -> list:
+    return search_token_regex.findall(query.lower())[:SEARCH_MAX_TOKENS]
+
+# Entries whose name has every token as a word prefix, best bm25 rank first
+def search_names(session, tokens, limit, offset):
+    if session.get_bind().dialect.name == "sqlite":
+        # quoted tokens, the query can't use FTS5 operators
+        match = " ".join(f'"{token}"*' for token in tokens)
+        return session.execute(
+            text(
+                "SELECT phonebook.id, phonebook.full_name, phonebook.phone_number, phonebook_fts.rank "
+                "FROM phonebook_fts JOIN phonebook ON phonebook.id = phonebook_fts.rowid "
+                "WHERE phonebook_fts MATCH :match ORDER BY phonebook_fts.rank LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        ).all()
+    # other databases have no FTS5 table, fall back to substring matches
+    return session.execute(
+        select(PhoneBook.id, PhoneBook.full_name, PhoneBook.phone_number)
+        .where(*[PhoneBook.full_name.ilike(f"%{token}%") for token in tokens])
+        .order_by(PhoneBook.id)
+        .limit(limit)
+        .offset(offset)
+    ).all()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+PHONE LOOKUP
+PREFIX AND SUFFIX OF THE NORMALIZED NUMBER
+'''
+
+LOOKUP_DEFAULT_LIMIT = 100
+LOOKUP_MAX_LIMIT = 1000
+
+# column >= value AND column < value with the last digit bumped, a range scan on column's index.
+# LIKE 'value%' would not use the index, SQLite's LIKE is case insensitive.
+def digits_range(column, value):
+    return column >= value, column < value[:-1] + chr(ord(value[-1]) + 1)
+
+# The bumped bound ('167:' after '1679') only works in byte order. PostgreSQL compares in the
+# database's locale unless told otherwise, so the ranges there use "C" and indexes built in it.
+LOOKUP_COLLATIONS = {"postgresql": "C"}
+LOOKUP_INDEX_DDL = {
+    "postgresql": [
+        'CREATE INDEX IF NOT EXISTS ix_phonebook_phone_digits_c ON phonebook (phone_digits COLLATE "C")',
+        'CREATE INDEX IF NOT EXISTS ix_phonebook_phone_digits_reversed_c ON phonebook (phone_digits_reversed COLLATE "C")',
+    ],
+}
+
+def create_lookup_indexes(conn):
+    for statement in LOOKUP_INDEX_DDL.get(conn.dialect.name, []):
+        conn.execute(text(statement))
+
+def lookup_column(column, dialect_name):
+    collation = LOOKUP_COLLATIONS.get(dialect_name)
+    return column if collation is None else column.collate(collation)
+
+# Entries whose normalized number starts with prefix and ends with suffix, in the order of the index scanned
+def lookup_query(prefix, suffix, dialect_name="sqlite"):
+    digits = lookup_column(PhoneBook.phone_digits, dialect_name)
+    reversed_digits = lookup_column(PhoneBook.phone_digits_reversed, dialect_name)
+    conditions = []
+    if prefix:
+        conditions += digits_range(digits, prefix)
+    if suffix:
+        conditions += digits_range(reversed_digits, reverse_digits(suffix))
+    # scan the prefix index when there is a prefix, the reversed one otherwise
+    order = digits if prefix else reversed_digits
+    return (
+        select(PhoneBook.id, PhoneBook.full_name, PhoneBook.phone_number)
+        .where(*conditions)
+        .order_by(order, PhoneBook.id)
+    )
+
+def lookup_numbers(session, prefix, suffix, limit, offset):
+    query = lookup_query(prefix, suffix, session.get_bind().dialect.name)
+    return session.execute(query.limit(limit).offset(offset)).all()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+CHANGE FEED
+INSERTS AND TOMBSTONES AFTER A VERSION
+'''
+
+CHANGES_DEFAULT_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
+# The changes after since, oldest first, an index range scan on the primary key
+def fetch_changes(session, since, limit):
+    return session.execute(
+        select(PhoneBookChange.version, PhoneBookChange.op, PhoneBookChange.person_id, PhoneBookChange.full_name, PhoneBookChange.phone_number)
+        .where(PhoneBookChange.version > since)
+        .order_by(PhoneBookChange.version)
+        .limit(limit)
+    ).all()
+
+def format_change(version, row) -> dict:
+    return {"version": version, "op": row.op, "id": row.person_id, "full_name": row.full_name, "phone_number": row.phone_number}
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+STREAMING EXPORT
+NDJSON AND CSV
+'''
+
+# Rows fetched from the cursor per round trip, also the size of each chunk sent
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CSV_HEADER = "id,full_name,phone_number\r\n"
+
+# shard and shard_count turn the ids into global ids of a sharded store
+def export_query(shard=0, shard_count=1):
+    id_column = PhoneBook.id if shard_count == 1 else (PhoneBook.id * shard_count + shard).label("id")
+    return (
+        select(id_column, PhoneBook.full_name, PhoneBook.phone_number)
+        .order_by(PhoneBook.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+def format_export_batch(export_format: str, batch) -> str:
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        return buffer.getvalue()
+    return "".join(
+        json.dumps({"id": row.id, "full_name": row.full_name, "phone_number": row.phone_number}) + "\n"
+        for row in batch
+    )
+
+# Yield the phonebook chunk by chunk, only one batch of rows is held in memory
+def stream_export(export_format: str):
+    init_engine()
+    session = Session()
+    try:
+        result = session.execute(export_query())
+        if export_format == "csv":
+            yield EXPORT_CSV_HEADER
+        for batch in result.partitions():
+            yield format_export_batch(export_format, batch)
+    finally:
+        session.close()
+
+# Same stream for the async mode, read from a server-side cursor on the async engine
+async def stream_export_async(export_format: str):
+    await init_async_engine()
+    async with async_engine.connect() as conn:
+        result = await conn.stream(export_query())
+        if export_format == "csv":
+            yield EXPORT_CSV_HEADER
+        async for batch in result.partitions():
+            yield format_export_batch(export_format, batch)
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+BULK OPERATIONS
+'''
+
+# Largest array accepted by one bulk request
+BULK_MAX_ITEMS = 10000
+# Rows or keys per statement, keeps the statement under the bound parameter limit
+BULK_QUERY_CHUNK = 500
+
+# Largest number of values in one /PhoneBook/validate request
+VALIDATE_MAX_ITEMS = 200000
+
+class ValidateIn(BaseModel):
+    names: List[str] = []
+    phone_numbers: List[str] = []
+
+class PersonIn(BaseModel):
+    full_name: str
+    phone_number: str
+
+# Validate, dedupe and insert many people with one statement per step, caller commits.
+# Returns one result per input, in input order. validated skips the checks already done by an import.
+def add_people(session, people, validated=False) -> list:
+    results = [None] * len(people)
+    candidates = {}
+    with requestProfiler.stage("validator"):
+        for index, (full_name, phone_number) in enumerate(people):
+            if not validated and not validate_name(full_name):
+                results[index] = {"index": index, "status": "invalid_name", "detail": "Invalid input for name"}
+            elif not validated and not validate_phone(phone_number):
+                results[index] = {"index": index, "status": "invalid_phone", "detail": "Invalid input for phone number"}
+            else:
+                key = (full_name, normalize_phone(phone_number))
+                if key in candidates:
+                    results[index] = {"index": index, "status": "duplicate", "detail": "Person already exists"}
+                else:
+                    candidates[key] = index
+
+    # one multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING per chunk, the rows not returned were stored already
+    keys = list(candidates)
+    added = set()
+    for start in range(0, len(keys), BULK_QUERY_CHUNK):
+        rows = [
+            {"full_name": full_name, "phone_number": people[candidates[(full_name, digits)]][1], "phone_digits": digits, "phone_digits_reversed": reverse_digits(digits)}
+            for full_name, digits in keys[start:start + BULK_QUERY_CHUNK]
+        ]
+        added.update(
+            tuple(row) for row in session.execute(
+                insert_new_people(session).values(rows).returning(PhoneBook.full_name, PhoneBook.phone_digits)
+            )
+        )
+
+    for key, index in candidates.items():
+        if key in added:
+            results[index] = {"index": index, "status": "added"}
+        else:
+            results[index] = {"index": index, "status": "duplicate", "detail": "Person already exists"}
+    return results
+
+class BulkDeleteIn(BaseModel):
+    full_names: List[str] = []
+    phone_numbers: List[str] = []
+    # delete every match of a name or number instead of only the first one
+    all_matches: bool = False
+
+# A deleted row and the requested key it was deleted for, ("name", full_name) or ("number", phone_digits)
+DeletedPerson = namedtuple("DeletedPerson", "key id full_name phone_number")
+
+# Delete the rows matching names and/or normalized numbers, caller commits.
+# Every deleted row goes to one key, names before numbers. Returns the deleted rows with their key.
+def delete_people(session, full_names, phone_digits, all_matches=False) -> list:
+    names = list(dict.fromkeys(full_names))
+    numbers = list(dict.fromkeys(phone_digits))
+    if all_matches:
+        # one DELETE ... RETURNING per chunk. A row with a requested name is the name's,
+        # whichever chunk deleted it, so the split into chunks doesn't matter.
+        requested_names = set(names)
+        keys = [("name", name) for name in names] + [("number", digits) for digits in numbers]
+        deleted = []
+        for start in range(0, len(keys), BULK_QUERY_CHUNK):
+            chunk = keys[start:start + BULK_QUERY_CHUNK]
+            condition = or_(
+                PhoneBook.full_name.in_([value for kind, value in chunk if kind == "name"]),
+                PhoneBook.phone_digits.in_([value for kind, value in chunk if kind == "number"]),
+            )
+            for row in delete_returning(session, condition):
+                key = ("name", row.full_name) if row.full_name in requested_names else ("number", row.phone_digits)
+                deleted.append(DeletedPerson(key, row.id, row.full_name, row.phone_number))
+        return deleted
+    # the first match is the lowest id per key. The names' rows are deleted first,
+    # so a number whose first row a name took gets its next match.
+    deleted = []
+    for kind, column, values in (("name", PhoneBook.full_name, names), ("number", PhoneBook.phone_digits, numbers)):
+        for start in range(0, len(values), BULK_QUERY_CHUNK):
+            first_ids = select(func.min(PhoneBook.id)).where(column.in_(values[start:start + BULK_QUERY_CHUNK])).group_by(column)
+            deleted.extend(
+                DeletedPerson((kind, getattr(row, column.key)), row.id, row.full_name, row.phone_number)
+                for row in delete_returning(session, PhoneBook.id.in_(first_ids))
+            )
+    return deleted
+
+def delete_returning(session, condition):
+    return session.execute(
+        delete(PhoneBook)
+        .where(condition)
+        .returning(PhoneBook.id, PhoneBook.full_name, PhoneBook.phone_number, PhoneBook.phone_digits)
+        .execution_options(synchronize_session=False)
+    )
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+BULK IMPORT
+CSV AND NDJSON FILES, see bulkImport.py
+'''
+
+import_id_regex = re.compile(r'^[0-9a-f]{32}$')
+# Bytes copied per read when saving an upload
+IMPORT_COPY_BUFFER = 1024 * 1024
+# import id -> (job, task) of the imports running in this process
+running_imports = {}
+
+# Store one chunk from the import's worker thread, the same write path as /PhoneBook/bulkAdd
+def import_write(people):
+    return from_thread.run(store_add_people, people, True)
+
+def new_import(path, import_format=None, state_path=None, rejects_path=None, chunk_size=None, workers=None, on_progress=None):
+    return BulkImport(
+        path,
+        import_write,
+        import_format,
+        state_path,
+        rejects_path,
+        chunk_size=chunk_size or settings.import_chunk_size,
+        workers=settings.import_workers if workers is None else workers,
+        parallel_min_bytes=settings.import_parallel_min_bytes,
+        on_progress=on_progress,
+    )
+
+# Run an import in a worker thread, a failure is kept in the checkpoint.
+# A finished import won't be resumed, its upload is removed.
+async def run_import(job):
+    try:
+        await run_in_threadpool(job.run)
+        if job.state["status"] == "done":
+            await run_in_threadpool(remove_file, job.path)
+    except Exception as e:
+        log_action("IMPORT FAILED", f"Import of {job.path} failed: {str(e)}")
+    return job.state
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Remove the checkpoints and rejects of imports finished more than settings.import_keep_hours ago
+def expire_imports():
+    if settings.import_keep_hours <= 0 or not os.path.isdir(settings.import_dir):
+        return
+    oldest = time.time() - settings.import_keep_hours * 3600
+    for entry in os.scandir(settings.import_dir):
+        import_id = entry.name[:-len(".import.json")]
+        if not entry.name.endswith(".import.json") or import_id in running_imports or entry.stat().st_mtime >= oldest:
+            continue
+        try:
+            with open(entry.path) as checkpoint:
+                finished = json.load(checkpoint).get("status") == "done"
+        except (OSError, ValueError):
+            continue
+        if finished:
+            for path in reversed(import_paths(import_id)):
+                remove_file(path)
+
+# For the command line, one import in an event loop of its own
+def run_import_now(job):
+    async def run():
+        try:
+            return await run_import(job)
+        finally:
+            write_queue.close()
+            close_shards()
+    return asyncio.run(run())
+
+def guess_import_format(upload) -> str:
+    if upload.content_type in ("application/x-ndjson", "application/jsonl"):
+        return "ndjson"
+    return guess_format(upload.filename or "")
+
+# Copy an upload to path, blocking, so it runs in the threadpool
+def save_upload(source, path):
+    with open(path, "wb") as upload:
+        shutil.copyfileobj(source, upload, IMPORT_COPY_BUFFER)
+
+# Upload, checkpoint and rejects of an import in settings.import_dir
+def import_paths(import_id):
+    base = os.path.join(settings.import_dir, import_id)
+    return base + ".upload", base + ".import.json", base + ".rejects.csv"
+
+# The job of an uploaded file, its format comes from the checkpoint when resuming
+def import_job(import_id, import_format=None):
+    source_path, state_path, rejects_path = import_paths(import_id)
+    if import_format is None:
+        with open(state_path) as checkpoint:
+            import_format = json.load(checkpoint)["format"]
+    return new_import(source_path, import_format, state_path, rejects_path)
+
+def start_import(import_id, job):
+    task = asyncio.create_task(run_import(job))
+    running_imports[import_id] = (job, task)
+    task.add_done_callback(lambda _: running_imports.pop(import_id, None))
+
+# Checkpoints are only written by the import thread, reading one is always safe
+def read_import_state(import_id):
+    if not import_id_regex.match(import_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Import not found")
+    running = running_imports.get(import_id)
+    if running is not None:
+        return {"id": import_id, **running[0].state}
+    try:
+        with open(import_paths(import_id)[1]) as checkpoint:
+            return {"id": import_id, **json.load(checkpoint)}
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Import not found")
+
+# Let running imports stop after their current chunk, they can be resumed after a restart
+async def stop_imports():
+    for job, _ in list(running_imports.values()):
+        job.cancel()
+    await asyncio.gather(*(task for _, task in list(running_imports.values())), return_exceptions=True)
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+SHARDED STORAGE
+ROUTED WRITES AND FAN-OUT READS, see shardStore.py
+'''
+
+# Set when settings.shard_count > 0, created on first use like the engine
+shard_store = None
+_shard_lock = threading.Lock()
+
+# Rows merged from several shards, id is the global id
+ShardRow = namedtuple("ShardRow", "id full_name phone_number")
+
+def create_shard_engine(url):
+    new_engine = create_phonebook_engine(dataclasses.replace(settings, database_url=url))
+    with new_engine.begin() as conn:
+        init_schema(conn)
+    return new_engine
+
+def init_shards():
+    global shard_store
+    if shard_store is None:
+        with _shard_lock:
+            if shard_store is None:
+                shard_store = ShardStore(
+                    settings.shard_urls,
+                    create_shard_engine,
+                    write_window=settings.write_window_ms / 1000,
+                    write_max_batch=settings.write_max_batch,
+                    on_batch=metrics.WRITE_BATCH_SIZE.observe,
+                )
+    return shard_store
+
+async def get_shards():
+    return shard_store if shard_store is not None else await run_in_threadpool(init_shards)
+
+def close_shards():
+    global shard_store
+    with _shard_lock:
+        store, shard_store = shard_store, None
+    if store is not None:
+        store.close()
+
+# Lowest id with this name, None when the shard has none
+def first_person_id(session, full_name):
+    return session.execute(select(func.min(PhoneBook.id)).where(PhoneBook.full_name == full_name)).scalar()
+
+# name -> lowest id with that name, for the names this shard has
+def first_ids_by_name(session, full_names) -> dict:
+    names = list(dict.fromkeys(full_names))
+    first_ids = {}
+    for start in range(0, len(names), BULK_QUERY_CHUNK):
+        first_ids.update(session.execute(
+            select(PhoneBook.full_name, func.min(PhoneBook.id))
+            .where(PhoneBook.full_name.in_(names[start:start + BULK_QUERY_CHUNK]))
+            .group_by(PhoneBook.full_name)
+        ).all())
+    return first_ids
+
+# The cursor of a sharded list holds the last id returned from every shard
+def encode_shard_cursor(after_ids) -> str:
+    raw = json.dumps({"ids": list(after_ids)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_shard_cursor(cursor: str, shard_count: int) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        after_ids = json.loads(base64.urlsafe_b64decode(padded.encode()))["ids"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    if not isinstance(after_ids, list) or len(after_ids) != shard_count or not all(isinstance(i, int) for i in after_ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return tuple(after_ids)
+
+# Every shard's next page, merged by global id. Each shard returns up to limit + 1 rows,
+# so there is a next page exactly when more than limit rows came back in total.
+async def sharded_page(after_ids, limit, selected):
+    store = await get_shards()
+    pages = await store.gather({shard: (fetch_versioned_page, (after_ids[shard], limit, selected)) for shard in range(store.count)})
+    version = sum(shard_version for shard_version, _ in pages.values())
+    candidates = sorted(
+        ((store.global_id(shard, row.id), shard, row) for shard, (_, rows) in pages.items() for row in rows),
+        key=lambda candidate: candidate[0],
+    )
+    next_ids = list(after_ids)
+    for _, shard, row in candidates[:limit]:
+        next_ids[shard] = row.id
+    next_cursor = encode_shard_cursor(next_ids) if len(candidates) > limit else None
+    items = [{f: global_id if f == "id" else getattr(row, f) for f in selected} for global_id, _, row in candidates[:limit]]
+    return version, items, next_cursor
+
+# bm25 ranks come from each shard's own index, close enough to merge on
+async def sharded_search(tokens, limit, offset):
+    store = await get_shards()
+    pages = await store.fan_out(search_names, tokens, offset + limit, 0)
+    merged = sorted(
+        (getattr(row, "rank", 0), store.global_id(shard, row.id), row) for shard, rows in enumerate(pages) for row in rows
+    )
+    return [ShardRow(global_id, row.full_name, row.phone_number) for _, global_id, row in merged[offset:offset + limit]]
+
+async def sharded_lookup(prefix, suffix, limit, offset):
+    store = await get_shards()
+    pages = await store.fan_out(lookup_numbers, prefix, suffix, offset + limit, 0)
+    # same order as the index each shard scanned
+    def scan_key(row):
+        digits = normalize_phone(row.phone_number)
+        return digits if prefix else digits[::-1]
+    merged = sorted(
+        (scan_key(row), store.global_id(shard, row.id), row) for shard, rows in enumerate(pages) for row in rows
+    )
+    return [ShardRow(global_id, row.full_name, row.phone_number) for _, global_id, row in merged[offset:offset + limit]]
+
+# Every shard's changes after its own version, merged like a list page, ids and versions are global
+async def sharded_changes(since_versions, limit):
+    store = await get_shards()
+    pages = await store.gather({shard: (fetch_changes, (since_versions[shard], limit + 1)) for shard in range(store.count)})
+    candidates = sorted(
+        ((store.global_id(shard, row.version), shard, row) for shard, rows in pages.items() for row in rows),
+        key=lambda candidate: candidate[0],
+    )
+    next_versions = list(since_versions)
+    items = []
+    for global_version, shard, row in candidates[:limit]:
+        next_versions[shard] = row.version
+        items.append({**format_change(global_version, row), "id": store.global_id(shard, row.person_id)})
+    return items, encode_shard_cursor(next_versions), len(candidates) > limit
+
+# Shard after shard, each one in id order
+def stream_sharded_export(export_format: str):
+    store = init_shards()
+    if export_format == "csv":
+        yield EXPORT_CSV_HEADER
+    for shard in range(store.count):
+        session = store.sessions[shard]()
+        try:
+            for batch in session.execute(export_query(shard, store.count)).partitions():
+                yield format_export_batch(export_format, batch)
+        finally:
+            session.close()
+
+# The first match is the lowest global id over all shards, if it's gone by the time
+# its shard deletes, the next shard with the name is tried
+async def sharded_delete_by_name(full_name):
+    store = await get_shards()
+    first_ids = await store.fan_out(first_person_id, full_name)
+    for _, shard in sorted((store.global_id(shard, i), shard) for shard, i in enumerate(first_ids) if i is not None):
+        person = await store.write(shard, run_write_op, delete_first_person, PhoneBook.full_name, full_name)
+        if person:
+            return person
+    return None
+
+# Every person goes to the shard of its number, results come back in input order
+async def sharded_add_people(people, validated=False):
+    store = await get_shards()
+    by_shard = {}
+    for index, (_, phone_number) in enumerate(people):
+        by_shard.setdefault(store.shard_for(normalize_phone(phone_number)), []).append(index)
+    results = await store.write_many({
+        shard: (run_write_op, (add_people, [people[index] for index in indexes], validated)) for shard, indexes in by_shard.items()
+    })
+    merged = [None] * len(people)
+    for shard, indexes in by_shard.items():
+        for index, result in zip(indexes, results[shard]):
+            merged[index] = {**result, "index": index}
+    return merged
+
+# Numbers are routed to their shard. Names are deleted on every shard with all_matches,
+# otherwise only on the shard holding the name's lowest global id.
+async def sharded_delete_people(full_names, phone_digits, all_matches):
+    store = await get_shards()
+    names = {shard: [] for shard in range(store.count)}
+    digits = {shard: [] for shard in range(store.count)}
+    if all_matches:
+        for shard in names:
+            names[shard] = list(full_names)
+    elif full_names:
+        first_ids = await store.fan_out(first_ids_by_name, full_names)
+        for name in dict.fromkeys(full_names):
+            found = [(store.global_id(shard, ids[name]), shard) for shard, ids in enumerate(first_ids) if name in ids]
+            if found:
+                names[min(found)[1]].append(name)
+    for value in phone_digits:
+        digits[store.shard_for(value)].append(value)
+    results = await store.write_many({
+        shard: (run_write_op, (delete_people, names[shard], digits[shard], all_matches))
+        for shard in range(store.count) if names[shard] or digits[shard]
+    })
+    return [row for shard in sorted(results) for row in results[shard]]
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+STORE ACCESS
+ONE DATABASE OR THE SHARDS, WHICHEVER settings PICKS
+'''
+
+async def store_version() -> int:
+    if settings.shard_count:
+        return sum(await (await get_shards()).fan_out(read_version))
+    return await run_db(read_version)
+
+# After is the id of the last row returned, or one per shard when sharded
+def decode_list_cursor(cursor):
+    if settings.shard_count:
+        return decode_shard_cursor(cursor, settings.shard_count) if cursor else (0,) * settings.shard_count
+    return decode_cursor(cursor) if cursor else 0
+
+# (version, items, next_cursor) of the page after after
+async def store_page(after, limit, selected):
+    if settings.shard_count:
+        return await sharded_page(after, limit, selected)
+    version, rows = await run_db(fetch_versioned_page, after, limit, selected)
+    # one extra row tells if there is a next page
+    next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+    items = [{f: getattr(row, f) for f in selected} for row in rows[:limit]]
+    return version, items, next_cursor
+
+# since is a version, or the last version of every shard when sharded
+def decode_changes_since(since):
+    if settings.shard_count:
+        return decode_shard_cursor(since, settings.shard_count) if since and since != "0" else (0,) * settings.shard_count
+    try:
+        return int(since or 0)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid since version")
+
+# (items, next_since, has_more) of the changes after since
+async def store_changes(since, limit):
+    if settings.shard_count:
+        return await sharded_changes(since, limit)
+    rows = await run_db(fetch_changes, since, limit + 1)
+    items = [format_change(row.version, row) for row in rows[:limit]]
+    return items, items[-1]["version"] if items else since, len(rows) > limit
+
+async def store_search(tokens, limit, offset):
+    if settings.shard_count:
+        return await sharded_search(tokens, limit, offset)
+    return await run_db(search_names, tokens, limit, offset)
+
+async def store_lookup(prefix, suffix, limit, offset):
+    if settings.shard_count:
+        return await sharded_lookup(prefix, suffix, limit, offset)
+    return await run_db(lookup_numbers, prefix, suffix, limit, offset)
+
+def store_export(export_format: str):
+    if settings.shard_count:
+        return stream_sharded_export(export_format)
+    return stream_export_async(export_format) if settings.async_mode else stream_export(export_format)
+
+# Write fn(session, *args) where the row of phone_digits lives
+async def store_write(phone_digits, fn, *args):
+    if settings.shard_count:
+        store = await get_shards()
+        return await store.write(store.shard_for(phone_digits), run_write_op, fn, *args)
+    return await run_write(fn, *args)
+
+async def store_delete_by_name(full_name):
+    if settings.shard_count:
+        return await sharded_delete_by_name(full_name)
+    return await run_write(delete_first_person, PhoneBook.full_name, full_name)
+
+async def store_add_people(people, validated=False):
+    if settings.shard_count:
+        return await sharded_add_people(people, validated)
+    return await run_write(add_people, people, validated)
+
+async def store_delete_people(full_names, phone_digits, all_matches):
+    if settings.shard_count:
+        return await sharded_delete_people(full_names, phone_digits, all_matches)
+    return await run_write(delete_people, full_names, phone_digits, all_matches)
 
 
 #########################################
@@ -200,56 +1426,169 @@ def validate_phone(phone) -> bool:
 ENDPOINTS
 '''
 
-# Login endpoint
-@app.post("/token")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
+# Login endpoint, the password is checked in the password pool
+@router.post("/token")
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     user = get_user(fake_users_db, form_data.username)
-    if not user or not verify_password(form_data.password, user['hashed_password']):
+    try:
+        started = time.perf_counter()
+        with requestProfiler.stage("bcrypt"):
+            verified = bool(user) and await password_pool.verify(form_data.password, user['hashed_password'])
+        if user:
+            metrics.PASSWORD_VERIFY_SECONDS.observe(time.perf_counter() - started)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins, try again later", headers={"Retry-After": "1"})
+    if not verified:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect username or password")
     access_token = create_access_token(data={"sub": user['username']})
     return {"access_token": access_token, "token_type": "bearer"}
 
-# List phonebook entries
-@app.get("/PhoneBook/list", status_code=status.HTTP_200_OK)
-def list_phonebook(current_user: str = Depends(authorize_read)):
+# Hit/miss counters of the verified-token cache
+@router.get("/token/stats", status_code=status.HTTP_200_OK)
+async def token_stats(current_user: str = Depends(authorize_read)):
+    return token_cache.stats()
+
+# List phonebook entries, one keyset page at a time ordered by id.
+# The ETag is the phonebook version: a matching If-None-Match gets a 304 after reading
+# only the version row, and pages already serialized at this version come from list_cache.
+@router.get("/PhoneBook/list", status_code=status.HTTP_200_OK)
+async def list_phonebook(
+    request: Request,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: str = Depends(authorize_read),
+):
+    selected = parse_fields(fields)
+    after = decode_list_cursor(cursor)
     try:
-        session = Session()
-        phonebook = session.query(PhoneBook).all()
-        session.close()
+        if not has_version_counter():
+            # nothing bumps the version, a cached page or an ETag would never go stale
+            _, items, next_cursor = await store_page(after, limit, selected)
+            log_action("LIST", "Listed phonebook entries")
+            return Response(content=fast_dumps({"items": items, "next_cursor": next_cursor}), media_type="application/json")
+
+        version = await store_version()
+        headers = {"ETag": list_etag(version), "Cache-Control": "no-cache"}
         log_action("LIST", "Listed phonebook entries")
-        return phonebook
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        body = list_cache.get((version, after, limit, selected))
+        if body is None:
+            # a write since store_version moves the page to the newer version
+            version, items, next_cursor = await store_page(after, limit, selected)
+            headers["ETag"] = list_etag(version)
+            body = fast_dumps({"items": items, "next_cursor": next_cursor})
+            list_cache.put((version, after, limit, selected), body)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
 
+# Prometheus text format, per-route latency, SQL timing, pool waits, bcrypt and audit writes, see metrics.py
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Inserts and deletes after since, oldest first. Poll again with next_since, right away while has_more.
+@router.get("/PhoneBook/changes", status_code=status.HTTP_200_OK)
+async def list_changes(
+    since: Optional[str] = None,
+    limit: int = Query(CHANGES_DEFAULT_LIMIT, ge=1, le=CHANGES_MAX_LIMIT),
+    current_user: str = Depends(authorize_read),
+):
+    # an empty feed would tell the client it is in sync
+    if database_backend() not in CHANGE_TRIGGER_DDL:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="No change feed on this database")
+    after = decode_changes_since(since)
+    try:
+        items, next_since, has_more = await store_changes(after, limit)
+        log_action("CHANGES", f"Listed phonebook changes since: {since or 0}")
+        return {"items": items, "next_since": next_since, "has_more": has_more}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+
+# Search names by word prefixes, "Schneier", "Bruce Sch"
+@router.get("/PhoneBook/search", status_code=status.HTTP_200_OK)
+async def search_phonebook(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+    offset: int = Query(0, ge=0, le=10000),
+    current_user: str = Depends(authorize_read),
+):
+    tokens = search_tokens(q)
+    if not tokens:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search query")
+    try:
+        rows = await store_search(tokens, limit + 1, offset)
+        items = [{"id": row.id, "full_name": row.full_name, "phone_number": row.phone_number} for row in rows[:limit]]
+        log_action("SEARCH", f"Searched phonebook entries for: {q}")
+        return {"items": items, "next_offset": offset + limit if len(rows) > limit else None}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+
+# Numbers starting with prefix and/or ending with suffix, formatting is ignored: "+1 670", "4567"
+@router.get("/PhoneBook/lookup", status_code=status.HTTP_200_OK)
+async def lookup_phonebook(
+    prefix: Optional[str] = Query(None, max_length=30),
+    suffix: Optional[str] = Query(None, max_length=30),
+    limit: int = Query(LOOKUP_DEFAULT_LIMIT, ge=1, le=LOOKUP_MAX_LIMIT),
+    offset: int = Query(0, ge=0, le=10000),
+    current_user: str = Depends(authorize_read),
+):
+    prefix_digits = normalize_phone(prefix or "")
+    suffix_digits = normalize_phone(suffix or "")
+    if not prefix_digits and not suffix_digits:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Give a prefix or suffix with digits")
+    try:
+        rows = await store_lookup(prefix_digits, suffix_digits, limit + 1, offset)
+        items = [{"id": row.id, "full_name": row.full_name, "phone_number": row.phone_number} for row in rows[:limit]]
+        log_action("LOOKUP", f"Looked up phone numbers with prefix: {prefix_digits} suffix: {suffix_digits}")
+        return {"items": items, "next_offset": offset + limit if len(rows) > limit else None}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+
+# Export the whole phonebook as a stream, for bulk sync jobs
+@router.get("/PhoneBook/export", status_code=status.HTTP_200_OK)
+async def export_phonebook(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    current_user: str = Depends(authorize_read),
+):
+    log_action("EXPORT", f"Exported phonebook entries as {export_format}")
+    return StreamingResponse(
+        store_export(export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="phonebook.{export_format}"'},
+    )
+
+# Check names and phone numbers without writing anything
+@router.post("/PhoneBook/validate", status_code=status.HTTP_200_OK)
+async def validate_inputs(request: ValidateIn, current_user: str = Depends(authorize_read)):
+    if len(request.names) + len(request.phone_numbers) > VALIDATE_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"At most {VALIDATE_MAX_ITEMS} values per request")
+    return await run_in_threadpool(validate_batch, request.names, request.phone_numbers)
+
 # Add person to phonebook 
-@app.post("/PhoneBook/add", status_code=status.HTTP_200_OK)
-def add_person(full_name: str, phone_number: str, current_user: str = Depends(authorize_write)):
+@router.post("/PhoneBook/add", status_code=status.HTTP_200_OK)
+async def add_person(full_name: str, phone_number: str, current_user: str = Depends(authorize_write)):
     try:
-        session = Session()
         # Validate name and phone number
-        if not validate_name(full_name):
+        with requestProfiler.stage("validator"):
+            valid_name, valid_phone = validate_name(full_name), validate_phone(phone_number)
+        if not valid_name:
             log_action("Adding denied due to invalidname", f"Denied these input: {full_name}, {phone_number}")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid input for name")
-        if not validate_phone(phone_number):
+        if not valid_phone:
             log_action("Adding denied due to invalidnumber", f"Denied these input: {full_name}, {phone_number}")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid input for phone number")
         
-        # Check if both full_name and phone_number match an existing record
-        existing_person = (
-            session.query(PhoneBook)
-            .filter_by(full_name=full_name, phone_number=phone_number)
-            .first()
-        )
-        if existing_person:
-            session.close()
+        # Check if both full_name and the normalized phone_number match an existing record
+        phone_digits = normalize_phone(phone_number)
+        added = await store_write(phone_digits, insert_person, full_name, phone_number, phone_digits)
+        if not added:
             log_action("Adding denied due to person already exists", f"Denied these input: {full_name},{phone_number}")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Person already exists")
 
-        new_person = PhoneBook(full_name=full_name, phone_number=phone_number)
-        session.add(new_person)
-        session.commit()
-        session.close()
-
         log_action("ADD", f"Added: {full_name}, {phone_number}")
         return {"message": "Person added successfully"}
     except HTTPException:
@@ -257,26 +1596,138 @@ def add_person(full_name: str, phone_number: str, current_user: str = Depends(au
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
 
+# Add many people in one request and one transaction
+@router.post("/PhoneBook/bulkAdd", status_code=status.HTTP_200_OK)
+async def bulk_add(people: List[PersonIn], current_user: str = Depends(authorize_write)):
+    if len(people) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"At most {BULK_MAX_ITEMS} entries per request")
+    # validated here and not in the writer, which holds the write lock while it runs
+    results = [None] * len(people)
+    valid = []
+    with requestProfiler.stage("validator"):
+        for index, person in enumerate(people):
+            if not validate_name(person.full_name):
+                results[index] = {"index": index, "status": "invalid_name", "detail": "Invalid input for name"}
+            elif not validate_phone(person.phone_number):
+                results[index] = {"index": index, "status": "invalid_phone", "detail": "Invalid input for phone number"}
+            else:
+                valid.append(index)
+    try:
+        stored = await store_add_people([(people[index].full_name, people[index].phone_number) for index in valid], validated=True)
+        for index, result in zip(valid, stored):
+            results[index] = {**result, "index": index}
+        added = sum(1 for result in results if result["status"] == "added")
+        log_action("BULK ADD", f"Added {added} of {len(people)} entries, rejected {len(people) - added}")
+        return {"added": added, "rejected": len(people) - added, "results": results}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+
+# Import a CSV or NDJSON file, the upload is saved and imported in the background.
+# Poll /PhoneBook/import/{id} for progress, rejected records are at /PhoneBook/import/{id}/rejects.
+# Both stay settings.import_keep_hours after the import is done.
+@router.post("/PhoneBook/import", status_code=status.HTTP_202_ACCEPTED)
+async def import_phonebook(
+    file: UploadFile = File(...),
+    import_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$"),
+    current_user: str = Depends(authorize_write),
+):
+    import_id = uuid.uuid4().hex
+    source_path = import_paths(import_id)[0]
+    try:
+        await run_in_threadpool(os.makedirs, settings.import_dir, exist_ok=True)
+        await run_in_threadpool(save_upload, file.file, source_path)
+        await run_in_threadpool(expire_imports)
+        job = await run_in_threadpool(new_import, source_path, import_format or guess_import_format(file), *import_paths(import_id)[1:])
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+    start_import(import_id, job)
+    log_action("IMPORT", f"Started import {import_id} of {file.filename}")
+    return {"id": import_id, **job.state}
+
+@router.get("/PhoneBook/import/{import_id}", status_code=status.HTTP_200_OK)
+async def import_status(import_id: str, current_user: str = Depends(authorize_write)):
+    return {**read_import_state(import_id), "running": import_id in running_imports}
+
+@router.get("/PhoneBook/import/{import_id}/rejects", status_code=status.HTTP_200_OK)
+async def import_rejects(import_id: str, current_user: str = Depends(authorize_write)):
+    read_import_state(import_id)
+    rejects_path = import_paths(import_id)[2]
+    if not os.path.exists(rejects_path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No rejects yet")
+    return FileResponse(rejects_path, media_type="text/csv", filename=f"{import_id}.rejects.csv")
+
+# Continue an interrupted or failed import from its last checkpoint
+@router.post("/PhoneBook/import/{import_id}/resume", status_code=status.HTTP_202_ACCEPTED)
+async def resume_import(import_id: str, current_user: str = Depends(authorize_write)):
+    state = read_import_state(import_id)
+    if import_id in running_imports:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Import is running")
+    if state["status"] == "done":
+        return state
+    job = await run_in_threadpool(import_job, import_id)
+    start_import(import_id, job)
+    log_action("IMPORT", f"Resumed import {import_id} at record {job.state['records']}")
+    return {"id": import_id, **job.state}
+
+# Delete many people by names and/or numbers in one request and one transaction
+@router.put("/PhoneBook/bulkDelete", status_code=status.HTTP_200_OK)
+async def bulk_delete(request: BulkDeleteIn, current_user: str = Depends(authorize_write)):
+    if len(request.full_names) + len(request.phone_numbers) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"At most {BULK_MAX_ITEMS} entries per request")
+    name_results = [{"full_name": name, "status": "not_found", "deleted": 0} for name in request.full_names]
+    number_results = [{"phone_number": number, "status": "not_found", "deleted": 0} for number in request.phone_numbers]
+    with requestProfiler.stage("validator"):
+        for result in name_results:
+            if not validate_name(result["full_name"]):
+                result["status"] = "invalid_name"
+        for result in number_results:
+            if not validate_phone(result["phone_number"]):
+                result["status"] = "invalid_phone"
+    try:
+        deleted = await store_delete_people(
+            [r["full_name"] for r in name_results if r["status"] != "invalid_name"],
+            [normalize_phone(r["phone_number"]) for r in number_results if r["status"] != "invalid_phone"],
+            request.all_matches,
+        )
+
+        # count every deleted row against the one name or number it was deleted for. A name or number
+        # asked for twice ("670-123-4567" and "(670) 123-4567") is counted on its first item, the others are duplicates
+        by_key = Counter(row.key for row in deleted)
+        requested = [(("name", r["full_name"]), r) for r in name_results]
+        requested += [(("number", normalize_phone(r["phone_number"])), r) for r in number_results]
+        seen = set()
+        for key, result in requested:
+            if result["status"] != "not_found":
+                continue
+            if key in seen:
+                result["status"] = "duplicate"
+            elif by_key[key]:
+                result.update(status="deleted", deleted=by_key[key])
+            seen.add(key)
+
+        details = "; ".join(f"{row.full_name},{row.phone_number}" for row in deleted)
+        log_action("BULK DELETE", f"Deleted {len(deleted)} entries, details: {details}")
+        return {"deleted": len(deleted), "full_names": name_results, "phone_numbers": number_results}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
+
 # Delete person by name 
-@app.put("/PhoneBook/deleteByName", status_code=status.HTTP_200_OK)
-def delete_by_name(full_name: str, current_user: str = Depends(authorize_write)):
+@router.put("/PhoneBook/deleteByName", status_code=status.HTTP_200_OK)
+async def delete_by_name(full_name: str, current_user: str = Depends(authorize_write)):
     try:
-        if(not validate_name(full_name)):
+        with requestProfiler.stage("validator"):
+            valid_name = validate_name(full_name)
+        if(not valid_name):
             log_action("DeleteByName denied due to invalidname", f"Denied these input: {full_name}")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid input for name")
-        session = Session()
         
         # get the first match of the person, if there are more than 1 name
-        person = session.query(PhoneBook).filter_by(full_name=full_name).first()
+        person = await store_delete_by_name(full_name)
         
         if not person:
-            session.close()
             log_action("DeleteByName denied due to person not found", f"Denied these input: {full_name}")
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Person not found")
-        phonenumber = person.phone_number
-        session.delete(person)
-        session.commit()
-        session.close()
+        phonenumber = person[1]
         log_action("DELETE", f"Deleted by name, details: {full_name},{phonenumber}")
         return {"message": "Person deleted successfully"}
     except HTTPException:
@@ -285,24 +1736,22 @@ def delete_by_name(full_name: str, current_user: str = Depends(authorize_write))
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
 
 # Delete person by phone number 
-@app.put("/PhoneBook/deleteByNumber", status_code=status.HTTP_200_OK)
-def delete_by_number(phone_number: str, current_user: str = Depends(authorize_write)):
+@router.put("/PhoneBook/deleteByNumber", status_code=status.HTTP_200_OK)
+async def delete_by_number(phone_number: str, current_user: str = Depends(authorize_write)):
     try:
-        session = Session()
-        if(not validate_phone(phone_number)):
+        with requestProfiler.stage("validator"):
+            valid_phone = validate_phone(phone_number)
+        if(not valid_phone):
             log_action("DeleteByNumber denied due to invalidnumber", f"Denied these input: {phone_number}")
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid input for phone number")
         #fetch the first intstance of user that match the phone number
-        person = session.query(PhoneBook).filter_by(phone_number=phone_number).first()
+        phone_digits = normalize_phone(phone_number)
+        person = await store_write(phone_digits, delete_first_person, PhoneBook.phone_digits, phone_digits)
         
         if not person:
-            session.close()
             log_action("DeleteByNumber denied due to number not found", f"Denied these input: {phone_number}")
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Number not found")
-        session.delete(person)
-        session.commit()
-        session.close()
-        log_action("DELETE", f"Deleted by phone number, details: {phone_number},{person.full_name}")
+        log_action("DELETE", f"Deleted by phone number, details: {phone_number},{person[0]}")
         return {"message": "Person deleted successfully"}
     except HTTPException:
         raise
@@ -310,7 +1759,7 @@ def delete_by_number(phone_number: str, current_user: str = Depends(authorize_wr
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An error occurred: {str(e)}")
 
 '''
-@app.delete("/PhoneBook/clear", status_code=status.HTTP_200_OK)
+@router.delete("/PhoneBook/clear", status_code=status.HTTP_200_OK)
 def clear_phonebook(current_user: str = Depends(authorize_write)):
     """
     Clear all entries from the phonebook. Restricted to write-access users.
@@ -330,6 +1779,58 @@ def clear_phonebook(current_user: str = Depends(authorize_write)):
         )
 '''
 
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+'''
+APP FACTORY
+'''
+
+# Warm up everything that was deferred at import, stop the workers and flush the audit log at shutdown
+@asynccontextmanager
+async def lifespan(app):
+    password_pool.start()
+    fake_users_db.load()
+    if settings.shard_count:
+        await run_in_threadpool(init_shards)
+    elif settings.async_mode:
+        await init_async_engine()
+    else:
+        await run_in_threadpool(init_engine)
+    await run_in_threadpool(expire_imports)
+    yield
+    await stop_imports()
+    write_queue.close()
+    close_shards()
+    password_pool.shutdown()
+    audit_logger.close()
+
+# Importing main only defines things, the engine, the user store and the password
+# workers start in the lifespan or on first use
+# Responses are encoded with fastJson.py and gzipped when the client accepts it and they are large enough
+def create_app():
+    new_app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    if settings.gzip_minimum_size > 0:
+        new_app.add_middleware(GZipMiddleware, minimum_size=settings.gzip_minimum_size, compresslevel=settings.gzip_level)
+    # off unless a directory is set, the middleware isn't even installed then
+    if settings.profile_dir:
+        new_app.add_middleware(
+            requestProfiler.ProfilerMiddleware,
+            directory=settings.profile_dir,
+            header=settings.profile_header,
+            query=settings.profile_query,
+            sample_rate=settings.profile_sample_rate,
+            authorize=profile_authorized,
+        )
+    # outermost, the latency includes compression
+    new_app.add_middleware(metrics.MetricsMiddleware)
+    new_app.include_router(router)
+    return new_app
+
+app = create_app()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
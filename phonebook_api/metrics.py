@@ -0,0 +1,177 @@
+import time
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+
+'''
+Metrics
+Counters and histograms kept in memory and rendered in the Prometheus text
+format at /metrics. An observation is a bisect and a few additions under a
+lock, cheap enough to stay on in production. SQL statements are timed with
+cursor events and also counted against the request that ran them.
+'''
+
+# Seconds, from a fast index lookup to a slow bcrypt or a big export
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket, with +Inf last], sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # first bucket whose upper bound is >= value, counts are made cumulative when rendered
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "phonebook_http_requests_total", "HTTP requests by route, method and status code", ("route", "method", "status")))
+REQUEST_SECONDS = registry.register(Histogram(
+    "phonebook_http_request_duration_seconds", "HTTP request latency by route", ("route", "method")))
+REQUEST_STATEMENTS = registry.register(Histogram(
+    "phonebook_http_request_sql_statements", "SQL statements run per HTTP request", ("route", "method"), COUNT_BUCKETS))
+STATEMENT_SECONDS = registry.register(Histogram(
+    "phonebook_sql_statement_duration_seconds", "SQL statement execution time", ("statement",)))
+POOL_CHECKOUT_SECONDS = registry.register(Histogram(
+    "phonebook_db_pool_checkout_seconds", "Wait for a database connection from the pool"))
+PASSWORD_VERIFY_SECONDS = registry.register(Histogram(
+    "phonebook_password_verify_seconds", "bcrypt verification at /token, pool queueing included"))
+AUDIT_WRITE_SECONDS = registry.register(Histogram(
+    "phonebook_audit_write_seconds", "Audit log batch write time"))
+AUDIT_DROPPED = registry.register(Counter(
+    "phonebook_audit_dropped_records_total", "Audit records lost to a full queue or a failed write"))
+# shown as 0 before the first loss, an alert can then tell "none lost" from "not exported"
+AUDIT_DROPPED.inc(amount=0)
+WRITE_BATCH_SIZE = registry.register(Histogram(
+    "phonebook_write_batch_size", "Writes committed together by the write queue", buckets=COUNT_BUCKETS))
+
+# Statements counted for the request being handled, set by MetricsMiddleware.
+# Worker threads and AsyncSession.run_sync run in a copy of the request's context, so they see it too.
+request_statements = ContextVar("request_statements", default=None)
+
+# Time every statement on sync_engine, the async engine passes its sync_engine
+def instrument_engine(sync_engine):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+        # first keyword only, full statements would make a series per query
+        STATEMENT_SECONDS.observe(elapsed, statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "")
+        counter = request_statements.get()
+        if counter is not None:
+            counter[0] += 1
+
+    # a failed statement never reaches after_cursor_execute
+    @event.listens_for(sync_engine, "handle_error")
+    def drop_statement(context):
+        started = context.connection.info.get("statement_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+# Pure ASGI middleware, labels by the route template ("/PhoneBook/list") so ids and queries don't create series
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        counter = [0]
+        token = request_statements.set(counter)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_statements.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUESTS.inc(route, method, str(status_code[0]))
+            REQUEST_SECONDS.observe(elapsed, route, method)
+            REQUEST_STATEMENTS.observe(counter[0], route, method)
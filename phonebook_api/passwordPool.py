@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+'''
+Password verification pool
+bcrypt is slow on purpose and holds the GIL, so logins are verified in worker
+processes. The number of logins waiting or running is bounded, a login over
+the bound fails fast with PasswordPoolBusy instead of queueing.
+A pool broken by a dying worker is replaced on the next login.
+'''
+
+pwd_context = None
+
+# passlib and its bcrypt backend are loaded on first use, not at import
+def get_pwd_context():
+    global pwd_context
+    if pwd_context is None:
+        from passlib.context import CryptContext
+        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return pwd_context
+
+# Password verification, runs in a worker process
+def verify_password(plain_password, hashed_password):
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+class PasswordPoolBusy(Exception):
+    pass
+
+class PasswordPool:
+    # workers=0 verifies in threads instead of processes
+    def __init__(self, workers=1, max_pending=64):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # Start the workers now instead of on the first login
+    def start(self):
+        if self._executor is not None:
+            return self._executor
+        with self._lock:
+            if self._executor is None:
+                if self.workers <= 0:
+                    self._executor = ThreadPoolExecutor(thread_name_prefix="password")
+                else:
+                    # spawn, a worker doesn't inherit the app's threads and connections. It imports
+                    # this module, and under `python main.py` main.py too as __mp_main__: that only
+                    # defines things, the server is started under the __main__ guard
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def verify(self, plain_password, hashed_password) -> bool:
+        executor = self.start()
+        try:
+            return await self._verify_in(executor, plain_password, hashed_password)
+        except BrokenProcessPool:
+            # a worker died (OOM killed, ...) and the pool can't be used again, retry once in a new one
+            self._discard(executor)
+            return await self._verify_in(self.start(), plain_password, hashed_password)
+
+    async def _verify_in(self, executor, plain_password, hashed_password) -> bool:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PasswordPoolBusy()
+            self._pending += 1
+        try:
+            future = executor.submit(verify_password, plain_password, hashed_password)
+        except BaseException:
+            self._done(None)
+            raise
+        # freed when the worker is done and not when the caller stops waiting,
+        # a cancelled login keeps its slot while its hash is still being checked
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    # Drop a broken executor, unless another login already replaced it
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
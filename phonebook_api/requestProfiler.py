@@ -0,0 +1,140 @@
+import os
+import re
+import json
+import time
+import random
+import cProfile
+import pstats
+import datetime
+import threading
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+from starlette.concurrency import run_in_threadpool
+
+'''
+Per-request profiler
+Runs one request under cProfile when it asks for it (header or query flag)
+and authorize() accepts the caller, or for a random sample of requests. The
+profile is written to a directory as <time>-<route>.prof, next to a .json
+with the route, the status and the time spent in each stage (validator,
+database, bcrypt, the rest is "other").
+cProfile hooks the thread it runs on: work in the event loop thread is in the
+profile, including anything concurrent requests do meanwhile, and stage()
+blocks running in worker threads are profiled on their own thread and merged in.
+The stage times are measured on their own and don't depend on cProfile.
+Nothing of this runs when no request is being profiled, stage() is then a
+ContextVar lookup.
+'''
+
+_NO_STAGE = nullcontext()
+current_profile = ContextVar("current_profile", default=None)
+
+class RequestProfile:
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.profiler = cProfile.Profile()
+        self.thread_profiles = []
+        self.stages = {}
+        # [name, start, time in nested stages] of the stages entered and not left yet
+        self._stack = []
+        self._lock = threading.Lock()
+
+    # Time in a stage is exclusive, the database stage of a bulk add doesn't count its validator time
+    @contextmanager
+    def stage(self, name):
+        entry = [name, time.perf_counter(), 0.0]
+        with self._lock:
+            self._stack.append(entry)
+        profiler = None
+        if threading.get_ident() != self.thread:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # 3.12+ profiles every thread from the one profiler and allows no second one
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.thread_profiles.append(profiler)
+            elapsed = time.perf_counter() - entry[1]
+            with self._lock:
+                self._stack.remove(entry)
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed - entry[2]
+                if self._stack:
+                    self._stack[-1][2] += elapsed
+
+    def stats(self):
+        stats = pstats.Stats(self.profiler)
+        for profiler in self.thread_profiles:
+            stats.add(profiler)
+        return stats
+
+# Time a block as one stage of the request being profiled, free when none is
+def stage(name):
+    profile = current_profile.get()
+    return _NO_STAGE if profile is None else profile.stage(name)
+
+def route_slug(route):
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip("_") or "root"
+
+# Pure ASGI middleware, only added to the app when a profile directory is set.
+# authorize(headers) gets the request headers, lowercase names, and says if the caller may ask for a profile.
+class ProfilerMiddleware:
+    def __init__(self, app, directory, header="x-profile", query="profile", sample_rate=0.0, authorize=None):
+        self.app = app
+        self.directory = directory
+        self.header = header.lower().encode()
+        self.query = query
+        self.sample_rate = sample_rate
+        self.authorize = authorize
+        # cProfile can only profile the event loop thread once at a time
+        self._busy = threading.Lock()
+
+    def wants_profile(self, scope):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return True
+        headers = dict(scope["headers"])
+        flagged = self.header in headers or self.query in parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if not flagged or self.authorize is None:
+            return False
+        return self.authorize({name.decode("latin-1"): value.decode("latin-1") for name, value in headers.items()})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wants_profile(scope) or not self._busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+        status_code = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+        profile.profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profile.profiler.disable()
+            elapsed = time.perf_counter() - start
+            current_profile.reset(token)
+            self._busy.release()
+            route = getattr(scope.get("route"), "path", scope["path"])
+            await run_in_threadpool(self.write, profile, route, scope["method"], status_code[0], elapsed)
+
+    def write(self, profile, route, method, status_code, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{method}-{route_slug(route)}"
+        path = os.path.join(self.directory, name)
+        profile.stats().dump_stats(path + ".prof")
+        stages = {stage_name: round(seconds, 6) for stage_name, seconds in profile.stages.items()}
+        stages["other"] = round(max(0.0, elapsed - sum(profile.stages.values())), 6)
+        with open(path + ".json", "w") as summary:
+            json.dump({"route": route, "method": method, "status": status_code, "seconds": round(elapsed, 6), "stages": stages}, summary, indent=2)
+        return path
@@ -0,0 +1,171 @@
+import os
+from dataclasses import dataclass
+from sqlalchemy.engine import make_url
+
+'''
+SETTINGS
+Read once from PHONEBOOK_* environment variables, the defaults match a local run
+'''
+
+# Async driver used for each database in async mode
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def env_bool(name, default) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def env_int(name, default) -> int:
+    value = os.environ.get(name)
+    return default if value is None else int(value)
+
+def env_float(name, default) -> float:
+    value = os.environ.get(name)
+    return default if value is None else float(value)
+
+@dataclass(frozen=True)
+class Settings:
+    database_url: str = "sqlite:///phonebook.db"
+    # async def endpoints backed by an AsyncSession instead of the worker threadpool
+    async_mode: bool = False
+    # log every SQL statement, for debugging only
+    db_echo: bool = False
+    # connection pool, ignored for in-memory SQLite
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: int = 30
+    # SQLite pragmas set on every new connection, WAL lets readers run while a writer commits
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    # negative means KiB instead of pages
+    sqlite_cache_size: int = -64000
+    sqlite_busy_timeout: int = 5000
+    # audit records, one "timestamp - action: details" line each or one JSON object per line
+    audit_path: str = "audit.log"
+    audit_json: bool = False
+    # rotate the audit log at this many bytes keeping audit_backups old files, 0 never rotates.
+    # A rotation drops the oldest file, so it is off unless asked for
+    audit_max_bytes: int = 0
+    audit_backups: int = 5
+    # verified bearer tokens kept in memory, 0 disables the cache
+    token_cache_size: int = 10000
+    # bcrypt runs in this many worker processes at /token, 0 runs it in threads
+    password_workers: int = os.cpu_count() or 1
+    # logins waiting or running at once, /token answers 503 above it
+    password_max_pending: int = 64
+    # distinct names and phones whose verdict is memoized
+    validation_cache_size: int = 100000
+    # serialized /PhoneBook/list pages kept in memory, 0 disables the cache
+    list_cache_size: int = 1000
+    # responses at least this many bytes are gzipped for clients that accept it, 0 turns gzip off
+    gzip_minimum_size: int = 1024
+    gzip_level: int = 6
+    # cProfile output of single requests goes here, empty turns profiling off
+    profile_dir: str = ""
+    # a write user sends this header or query parameter to get the request profiled
+    profile_header: str = "X-Profile"
+    profile_query: str = "profile"
+    # fraction of all requests profiled without asking, 0.001 is one in a thousand
+    profile_sample_rate: float = 0.0
+    # writes are committed in batches by one writer thread, waiting up to the window for more writes.
+    # Not used in async mode, whose writes go through the async engine one transaction each
+    write_queue: bool = True
+    write_window_ms: float = 2.0
+    write_max_batch: int = 128
+    # split the phonebook over this many databases by a hash of the number, 0 keeps one database.
+    # {shard} in shard_url is replaced by the shard number, shards use sync engines even in async mode
+    shard_count: int = 0
+    shard_url: str = "sqlite:///phonebook-{shard}.db"
+    # uploaded imports, their checkpoints and rejects are kept here so an import can be resumed
+    import_dir: str = "imports"
+    # the upload of a finished import is removed right away, its checkpoint and rejects after this many hours.
+    # 0 keeps them. Failed and interrupted imports are kept for a resume, removing those is up to the operator
+    import_keep_hours: float = 24.0
+    # records validated and stored in one transaction
+    import_chunk_size: int = 1000
+    # validation processes for files of at least import_parallel_min_bytes, 0 validates in the import thread
+    import_workers: int = os.cpu_count() or 1
+    import_parallel_min_bytes: int = 8 * 1024 * 1024
+    # an old database storing a name and number twice can't get the unique index, migrating it stops and
+    # lists the rows. Set, all but the first of each are moved to phonebook_duplicates instead
+    migrate_remove_duplicates: bool = False
+
+    # Same database as database_url, with the async driver when none is given
+    @property
+    def async_database_url(self) -> str:
+        url = make_url(self.database_url)
+        if url.drivername in ASYNC_DRIVERS:
+            url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+        return url.render_as_string(hide_password=False)
+
+    # Keyword arguments for create_engine and create_async_engine
+    @property
+    def engine_options(self) -> dict:
+        options = {"echo": self.db_echo}
+        url = make_url(self.database_url)
+        if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+            options.update(pool_size=self.pool_size, max_overflow=self.max_overflow, pool_timeout=self.pool_timeout)
+        return options
+
+    @property
+    def shard_urls(self) -> list:
+        return [self.shard_url.format(shard=shard) for shard in range(self.shard_count)]
+
+    @property
+    def sqlite_pragmas(self) -> dict:
+        return {
+            "journal_mode": self.sqlite_journal_mode,
+            "synchronous": self.sqlite_synchronous,
+            "mmap_size": self.sqlite_mmap_size,
+            "cache_size": self.sqlite_cache_size,
+            "busy_timeout": self.sqlite_busy_timeout,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            database_url=os.environ.get("PHONEBOOK_DATABASE_URL", cls.database_url),
+            async_mode=env_bool("PHONEBOOK_ASYNC_MODE", cls.async_mode),
+            db_echo=env_bool("PHONEBOOK_DB_ECHO", cls.db_echo),
+            pool_size=env_int("PHONEBOOK_POOL_SIZE", cls.pool_size),
+            max_overflow=env_int("PHONEBOOK_MAX_OVERFLOW", cls.max_overflow),
+            pool_timeout=env_int("PHONEBOOK_POOL_TIMEOUT", cls.pool_timeout),
+            sqlite_journal_mode=os.environ.get("PHONEBOOK_SQLITE_JOURNAL_MODE", cls.sqlite_journal_mode),
+            sqlite_synchronous=os.environ.get("PHONEBOOK_SQLITE_SYNCHRONOUS", cls.sqlite_synchronous),
+            sqlite_mmap_size=env_int("PHONEBOOK_SQLITE_MMAP_SIZE", cls.sqlite_mmap_size),
+            sqlite_cache_size=env_int("PHONEBOOK_SQLITE_CACHE_SIZE", cls.sqlite_cache_size),
+            sqlite_busy_timeout=env_int("PHONEBOOK_SQLITE_BUSY_TIMEOUT", cls.sqlite_busy_timeout),
+            audit_path=os.environ.get("PHONEBOOK_AUDIT_PATH", cls.audit_path),
+            audit_json=env_bool("PHONEBOOK_AUDIT_JSON", cls.audit_json),
+            audit_max_bytes=env_int("PHONEBOOK_AUDIT_MAX_BYTES", cls.audit_max_bytes),
+            audit_backups=env_int("PHONEBOOK_AUDIT_BACKUPS", cls.audit_backups),
+            token_cache_size=env_int("PHONEBOOK_TOKEN_CACHE_SIZE", cls.token_cache_size),
+            password_workers=env_int("PHONEBOOK_PASSWORD_WORKERS", cls.password_workers),
+            password_max_pending=env_int("PHONEBOOK_PASSWORD_MAX_PENDING", cls.password_max_pending),
+            validation_cache_size=env_int("PHONEBOOK_VALIDATION_CACHE_SIZE", cls.validation_cache_size),
+            list_cache_size=env_int("PHONEBOOK_LIST_CACHE_SIZE", cls.list_cache_size),
+            gzip_minimum_size=env_int("PHONEBOOK_GZIP_MINIMUM_SIZE", cls.gzip_minimum_size),
+            gzip_level=env_int("PHONEBOOK_GZIP_LEVEL", cls.gzip_level),
+            profile_dir=os.environ.get("PHONEBOOK_PROFILE_DIR", cls.profile_dir),
+            profile_header=os.environ.get("PHONEBOOK_PROFILE_HEADER", cls.profile_header),
+            profile_query=os.environ.get("PHONEBOOK_PROFILE_QUERY", cls.profile_query),
+            profile_sample_rate=env_float("PHONEBOOK_PROFILE_SAMPLE_RATE", cls.profile_sample_rate),
+            write_queue=env_bool("PHONEBOOK_WRITE_QUEUE", cls.write_queue),
+            write_window_ms=env_float("PHONEBOOK_WRITE_WINDOW_MS", cls.write_window_ms),
+            write_max_batch=env_int("PHONEBOOK_WRITE_MAX_BATCH", cls.write_max_batch),
+            shard_count=env_int("PHONEBOOK_SHARD_COUNT", cls.shard_count),
+            shard_url=os.environ.get("PHONEBOOK_SHARD_URL", cls.shard_url),
+            import_dir=os.environ.get("PHONEBOOK_IMPORT_DIR", cls.import_dir),
+            import_keep_hours=env_float("PHONEBOOK_IMPORT_KEEP_HOURS", cls.import_keep_hours),
+            import_chunk_size=env_int("PHONEBOOK_IMPORT_CHUNK_SIZE", cls.import_chunk_size),
+            import_workers=env_int("PHONEBOOK_IMPORT_WORKERS", cls.import_workers),
+            import_parallel_min_bytes=env_int("PHONEBOOK_IMPORT_PARALLEL_MIN_BYTES", cls.import_parallel_min_bytes),
+            migrate_remove_duplicates=env_bool("PHONEBOOK_MIGRATE_REMOVE_DUPLICATES", cls.migrate_remove_duplicates),
+        )
+
+settings = Settings.from_env()
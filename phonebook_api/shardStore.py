@@ -0,0 +1,84 @@
+import zlib
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from writeQueue import WriteQueue
+
+'''
+Hash-sharded storage
+Rows are spread over several databases by a CRC32 of the normalized phone
+number, so every row of one number lives in one shard. Reads that can't be
+routed run on every shard at once in a thread pool of one thread per shard,
+writes go through one write queue per shard. Ids are local to a shard and
+shown as local_id * shard_count + shard, unique across shards.
+'''
+
+class ShardStore:
+    # engine_factory(url) returns an engine with the schema created
+    def __init__(self, urls, engine_factory, write_window=0.002, write_max_batch=128, on_batch=None):
+        self.urls = list(urls)
+        self.count = len(self.urls)
+        self.engines = [engine_factory(url) for url in self.urls]
+        self.sessions = [sessionmaker(bind=engine) for engine in self.engines]
+        self.write_queues = [
+            WriteQueue(sessions, window=write_window, max_batch=write_max_batch, on_batch=on_batch)
+            for sessions in self.sessions
+        ]
+        self._pool = ThreadPoolExecutor(self.count, thread_name_prefix="shard")
+        self._lock = threading.Lock()
+
+    # Stable across processes and restarts, unlike hash()
+    def shard_for(self, phone_digits) -> int:
+        return zlib.crc32(phone_digits.encode()) % self.count
+
+    def global_id(self, shard, local_id) -> int:
+        return local_id * self.count + shard
+
+    # (shard, local_id) of a global id
+    def split_id(self, global_id):
+        return global_id % self.count, global_id // self.count
+
+    # Run fn(session, *args) on one shard in a session of its own, no commit
+    def run(self, shard, fn, *args):
+        session = self.sessions[shard]()
+        try:
+            return fn(session, *args)
+        finally:
+            session.close()
+
+    async def read(self, shard, fn, *args):
+        loop = asyncio.get_running_loop()
+        # a context can only be entered by one thread at a time, each call gets a copy
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._pool, context.run, self.run, shard, fn, *args)
+
+    # calls is {shard: (fn, args)}, returns {shard: result}, all shards run at once
+    async def gather(self, calls):
+        shards = list(calls)
+        results = await asyncio.gather(*(self.read(shard, calls[shard][0], *calls[shard][1]) for shard in shards))
+        return dict(zip(shards, results))
+
+    # The same read on every shard, results in shard order
+    async def fan_out(self, fn, *args) -> list:
+        results = await self.gather({shard: (fn, args) for shard in range(self.count)})
+        return [results[shard] for shard in range(self.count)]
+
+    # Queue a write on one shard, committed with that shard's next batch
+    async def write(self, shard, fn, *args):
+        return await self.write_queues[shard].run(fn, *args)
+
+    # calls is {shard: (fn, args)}, every shard commits on its own
+    async def write_many(self, calls):
+        shards = list(calls)
+        results = await asyncio.gather(*(self.write(shard, calls[shard][0], *calls[shard][1]) for shard in shards))
+        return dict(zip(shards, results))
+
+    def close(self):
+        with self._lock:
+            for write_queue in self.write_queues:
+                write_queue.close()
+            self._pool.shutdown(wait=True)
+            for engine in self.engines:
+                engine.dispose()
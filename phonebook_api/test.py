@@ -1,11 +1,42 @@
+import csv
+import json
+import time
+import random
+import asyncio
+import threading
+import dataclasses
 import pytest
 import logging
 from httpx import AsyncClient
 from httpx import ASGITransport
-from main import app, phone_regex, name_regex, validate_name, validate_phone
-from main import validate_phone, validate_name
+from jose import jwt
+import main
+from main import app, validate_name, validate_phone
+from main import normalize_phone, migrate_phonebook, validate_batch
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from auditLogger import AuditLogger
+from settings import Settings
+from main import create_phonebook_engine, init_schema, search_names, search_tokens
+from main import PhoneBook, add_people, lookup_query, lookup_numbers
+from main import fetch_changes, delete_people, read_version, etag_matches, list_etag, insert_person, delete_first_person
+from sqlalchemy.orm import Session as OrmSession
+from tokenCache import TokenCache
+from lruCache import LRUCache
+import fastJson
+from metrics import Counter as MetricCounter, Histogram
+import requestProfiler
+from writeQueue import WriteQueue
+from shardStore import ShardStore
+from bulkImport import BulkImport
+from sqlalchemy.orm import sessionmaker
+from loginInfo import UserStore
+import passwordPool
+from passwordPool import PasswordPool, PasswordPoolBusy, get_pwd_context
 from testData import valid_phones, invalid_phones, valid_names, invalid_names
 from testData import valid_phones2, invalid_phones2, valid_names2, invalid_names2
+from testData import phone_regex, name_regex
+from validator import phone_scanner, name_scanner
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,6 +45,26 @@ logger = logging.getLogger(__name__)
 #THIS TEST FILE IS FOR UNIT TESTING OF INDIVIDUAL COMPONENTS
 #API TEST DOES NOT INCLUDED IN HERE, EXCEPT FOR AUTHORIZATION
 
+# Engine on a database with the current phonebook schema
+def schema_engine(url):
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        init_schema(conn)
+    return engine
+
+# Empty SQLite database of its own for every test, for old schemas built by hand
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'phonebook.db'}")
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def phonebook_engine(tmp_path):
+    engine = schema_engine(f"sqlite:///{tmp_path / 'phonebook.db'}")
+    yield engine
+    engine.dispose()
+
 
 #########################################
 #########################################
@@ -60,6 +111,624 @@ def test_validate_phone_numbers(phone, Iphone):
     assert not validate_phone(Iphone), f"Expected {Iphone} to be invalid"
 
 
+# The scanners in validator.py must give the regexes' verdict on every test case
+@pytest.mark.parametrize("phone", valid_phones + invalid_phones + valid_phones2 + invalid_phones2 + ["12345\n", "123-4567\n\n"])
+def test_phone_scanner_matches_regex(phone):
+    assert phone_scanner.match(phone) == bool(phone_regex.match(phone))
+
+@pytest.mark.parametrize("name", valid_names + invalid_names + valid_names2 + invalid_names2 + ["Cher\n"])
+def test_name_scanner_matches_regex(name):
+    assert name_scanner.match(name) == bool(name_regex.match(name))
+
+def test_scanners_match_regex_on_random_input():
+    rng = random.Random(2024)
+    for _ in range(20000):
+        phone = "".join(rng.choice("0123456789+()-. \n٣x") for _ in range(rng.randint(0, 22)))
+        assert phone_scanner.match(phone) == bool(phone_regex.match(phone)), repr(phone)
+        name = "".join(rng.choice("abXY-'’., \n1") for _ in range(rng.randint(0, 30)))
+        assert name_scanner.match(name) == bool(name_regex.match(name)), repr(name)
+
+@pytest.mark.parametrize("value", ["1" * 100000, "(" * 100000, "a" * 100000, "Ab-" * 30000 + "1"])
+def test_validators_reject_long_input(value):
+    assert not validate_phone(value)
+    assert not validate_name(value)
+
+def test_validate_batch():
+    result = validate_batch(valid_names + invalid_names, valid_phones + invalid_phones)
+    assert [r["valid"] for r in result["names"]] == [True] * len(valid_names) + [False] * len(invalid_names)
+    assert [r["valid"] for r in result["phone_numbers"]] == [True] * len(valid_phones) + [False] * len(invalid_phones)
+    assert result["phone_numbers"][valid_phones.index("670.123.4567")]["normalized"] == "6701234567"
+    assert all(r["normalized"] is None for r in result["phone_numbers"][len(valid_phones):])
+
+@pytest.mark.parametrize("phone, digits", [
+    ("670-123-4567", "6701234567"),
+    ("670.123.4567", "6701234567"),
+    ("(670)123-4567", "6701234567"),
+    ("+1 (949) 555-2671", "19495552671"),
+    ("12345", "12345"),
+    ("٣٣٣-٣٣٣٣", "3333333"),
+    ("１２３-４５６７", "1234567"),
+])
+def test_normalize_phone(phone, digits):
+    assert normalize_phone(phone) == digits
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# DATABASE MIGRATION TEST
+
+def test_migrate_phonebook_backfills_old_database(sqlite_engine, monkeypatch):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE phonebook (id INTEGER NOT NULL, full_name VARCHAR, phone_number VARCHAR, PRIMARY KEY (id))"))
+        conn.execute(text("INSERT INTO phonebook (full_name, phone_number) VALUES ('Bruce Schneier', '670.123.4567')"))
+        # stored twice before the unique index
+        conn.execute(text("INSERT INTO phonebook (full_name, phone_number) VALUES ('Bruce Schneier', '670-123-4567')"))
+        conn.execute(text("CREATE INDEX ix_phonebook_full_name_phone_digits ON phonebook (full_name)"))
+    # the migration stops and names the rows, nothing is changed
+    with pytest.raises(ValueError, match="id 2 'Bruce Schneier' '670-123-4567' repeats id 1"):
+        with sqlite_engine.begin() as conn:
+            migrate_phonebook(conn)
+    with sqlite_engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM phonebook WHERE phone_digits IS NULL")).scalar() == 2
+    # allowed, the duplicate is moved aside and logged
+    logged = []
+    monkeypatch.setattr(main, "settings", dataclasses.replace(main.settings, migrate_remove_duplicates=True))
+    monkeypatch.setattr(main, "log_action", lambda action, details: logged.append(details))
+    with sqlite_engine.begin() as conn:
+        migrate_phonebook(conn)
+    with sqlite_engine.begin() as conn:
+        migrate_phonebook(conn)
+    with sqlite_engine.connect() as conn:
+        assert conn.execute(text("SELECT id, phone_digits, phone_digits_reversed FROM phonebook")).one() == (1, "6701234567", "7654321076")
+        assert conn.execute(text("SELECT id, kept_id, full_name, phone_number FROM phonebook_duplicates")).all() == [(2, 1, "Bruce Schneier", "670-123-4567")]
+    assert logged == ["id 2, Bruce Schneier, 670-123-4567, same as id 1"]
+    indexes = {index["name"]: index for index in inspect(sqlite_engine).get_indexes("phonebook")}
+    assert {"uq_phonebook_full_name_phone_digits", "ix_phonebook_phone_digits", "ix_phonebook_phone_digits_reversed"} <= set(indexes)
+    assert indexes["uq_phonebook_full_name_phone_digits"]["unique"]
+    assert "ix_phonebook_full_name_phone_digits" not in indexes
+
+# A database that never had duplicates doesn't get their table
+def test_duplicates_table_only_created_by_migration(phonebook_engine):
+    assert "phonebook_duplicates" not in inspect(phonebook_engine).get_table_names()
+
+# Numbers stored while non-ASCII digits normalized to "" get their digits at the next start
+def test_migrate_phonebook_renormalizes_unicode_digits(phonebook_engine):
+    with phonebook_engine.begin() as conn:
+        conn.execute(text("INSERT INTO phonebook (full_name, phone_number, phone_digits, phone_digits_reversed) VALUES ('John Doe', '٣٣٣-٣٣٣٣', '', '')"))
+        migrate_phonebook(conn)
+    with phonebook_engine.connect() as conn:
+        assert conn.execute(text("SELECT phone_digits, phone_digits_reversed FROM phonebook")).one() == ("3333333", "3333333")
+
+def test_phone_lookup_uses_range_scans(phonebook_engine):
+    with OrmSession(phonebook_engine) as session:
+        add_people(session, [("Bruce Schneier", "+1 670 123 4567"), ("John Smith", "670-999-4567"), ("Jane Doe", "1 670 555 0000")])
+        session.commit()
+        assert [row.full_name for row in lookup_numbers(session, "1670", "", 10, 0)] == ["Bruce Schneier", "Jane Doe"]
+        assert [row.full_name for row in lookup_numbers(session, "", "4567", 10, 0)] == ["Bruce Schneier", "John Smith"]
+        assert [row.full_name for row in lookup_numbers(session, "1670", "4567", 10, 0)] == ["Bruce Schneier"]
+        assert lookup_numbers(session, "19", "", 10, 0) == []
+    with phonebook_engine.connect() as conn:
+        for prefix, suffix, index in (("1670", "", "ix_phonebook_phone_digits"), ("", "4567", "ix_phonebook_phone_digits_reversed")):
+            query = lookup_query(prefix, suffix).compile(phonebook_engine, compile_kwargs={"literal_binds": True})
+            plan = " ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {query}"))
+            assert f"USING INDEX {index} (" in plan
+
+# PostgreSQL compares the ranges in byte order, whatever the database's collation
+def test_phone_lookup_ranges_in_byte_order_on_postgresql():
+    sql = str(lookup_query("1679", "", "postgresql").compile(dialect=postgresql.dialect()))
+    assert '(phonebook.phone_digits COLLATE "C") >= ' in sql and '(phonebook.phone_digits COLLATE "C") < ' in sql
+    assert 'ORDER BY phonebook.phone_digits COLLATE "C"' in sql
+    assert "COLLATE" not in str(lookup_query("1679", "4567").compile(dialect=sqlite.dialect()))
+
+
+def test_name_index_built_for_existing_rows(sqlite_engine):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE phonebook (id INTEGER NOT NULL, full_name VARCHAR, phone_number VARCHAR, PRIMARY KEY (id))"))
+        conn.execute(text("INSERT INTO phonebook (full_name, phone_number) VALUES ('Schneier, Bruce', '12345'), ('John O’Malley-Smith', '12345')"))
+    with sqlite_engine.begin() as conn:
+        init_schema(conn)
+    with OrmSession(sqlite_engine) as session:
+        assert [row.full_name for row in search_names(session, search_tokens("Bruce Sch"), 10, 0)] == ["Schneier, Bruce"]
+        assert [row.full_name for row in search_names(session, search_tokens("malley"), 10, 0)] == ["John O’Malley-Smith"]
+        session.execute(text("DELETE FROM phonebook WHERE full_name = 'Schneier, Bruce'"))
+        assert search_names(session, search_tokens("Schneier"), 10, 0) == []
+
+@pytest.mark.parametrize("query, tokens", [
+    ("Bruce Sch", ["bruce", "sch"]),
+    ("Schneier, Bruce", ["schneier", "bruce"]),
+    ('O’Malley" OR *', ["o", "malley", "or"]),
+])
+def test_search_tokens(query, tokens):
+    assert search_tokens(query) == tokens
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# SETTINGS AND ENGINE TEST
+
+def test_settings_from_env(monkeypatch):
+    monkeypatch.setenv("PHONEBOOK_DATABASE_URL", "sqlite:///other.db")
+    monkeypatch.setenv("PHONEBOOK_POOL_SIZE", "20")
+    monkeypatch.setenv("PHONEBOOK_DB_ECHO", "true")
+    monkeypatch.setenv("PHONEBOOK_SQLITE_SYNCHRONOUS", "FULL")
+    monkeypatch.setenv("PHONEBOOK_AUDIT_JSON", "1")
+    monkeypatch.setenv("PHONEBOOK_AUDIT_MAX_BYTES", "1048576")
+    settings = Settings.from_env()
+    # the audit log only rotates when a size is set
+    assert Settings().audit_max_bytes == 0
+    assert (settings.audit_path, settings.audit_json, settings.audit_max_bytes) == ("audit.log", True, 1048576)
+    assert settings.database_url == "sqlite:///other.db"
+    assert settings.async_database_url == "sqlite+aiosqlite:///other.db"
+    assert settings.engine_options == {"echo": True, "pool_size": 20, "max_overflow": 10, "pool_timeout": 30}
+    assert settings.sqlite_pragmas["synchronous"] == "FULL"
+
+def test_sqlite_pragmas_applied(tmp_path):
+    engine = create_phonebook_engine(Settings(database_url=f"sqlite:///{tmp_path / 'wal.db'}", sqlite_cache_size=-2000))
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA cache_size")).scalar() == -2000
+    engine.dispose()
+
+def test_sqlite_pragma_values_are_checked():
+    with pytest.raises(ValueError):
+        create_phonebook_engine(Settings(database_url="sqlite://", sqlite_journal_mode="WAL; DROP TABLE phonebook"))
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# TOKEN CACHE TEST
+
+def test_token_cache_hits_and_misses():
+    cache = TokenCache(max_size=10)
+    assert cache.get("token") is None
+    cache.put("token", {"username": "adminuser"}, time.time() + 60)
+    assert cache.get("token") == {"username": "adminuser"}
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1, "max_size": 10}
+
+def test_token_cache_expires_with_token():
+    cache = TokenCache()
+    cache.put("expired", {"username": "adminuser"}, time.time() - 1)
+    cache.put("expiring", {"username": "adminuser"}, time.time() + 0.05)
+    assert cache.get("expired") is None
+    time.sleep(0.1)
+    assert cache.get("expiring") is None
+    assert cache.stats()["size"] == 0
+
+def test_token_cache_drops_least_recently_used():
+    cache = TokenCache(max_size=2)
+    expires_at = time.time() + 60
+    cache.put("a", {"username": "a"}, expires_at)
+    cache.put("b", {"username": "b"}, expires_at)
+    cache.get("a")
+    cache.put("c", {"username": "c"}, expires_at)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# LIST CACHE AND ETAG TEST
+
+def test_response_cache_drops_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.put((1, "a"), b"a")
+    cache.put((1, "b"), b"b")
+    assert cache.get((1, "a")) == b"a"
+    cache.put((2, "a"), b"a2")
+    assert cache.get((1, "b")) is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 2, "max_size": 2}
+
+@pytest.mark.parametrize("database_url, shard_count, counted", [
+    ("sqlite:///phonebook.db", 0, True),
+    ("postgresql://db/phonebook", 0, True),
+    ("mysql://db/phonebook", 0, False),
+    ("mysql://db/phonebook", 2, True),
+])
+def test_version_counter_dialects(monkeypatch, database_url, shard_count, counted):
+    monkeypatch.setattr(main, "settings", Settings(database_url=database_url, shard_count=shard_count))
+    assert main.has_version_counter() == counted
+    # the change feed is kept on the same databases
+    assert (main.database_backend() in main.CHANGE_TRIGGER_DDL) == counted
+
+def test_version_counter_bumped_by_every_write(phonebook_engine):
+    # a second start keeps the version row
+    with phonebook_engine.begin() as conn:
+        init_schema(conn)
+    with OrmSession(phonebook_engine) as session:
+        assert read_version(session) == 0
+        add_people(session, [("Bruce Schneier", "12345"), ("John Smith", "12345")])
+        session.commit()
+        assert read_version(session) == 2
+        delete_people(session, ["John Smith"], [], all_matches=True)
+        session.rollback()
+        assert read_version(session) == 2
+        delete_people(session, ["John Smith"], [], all_matches=True)
+        session.commit()
+        assert read_version(session) == 3
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ('"7"', True),
+    ('W/"7"', True),
+    ('"6", "7"', True),
+    ("*", True),
+    ('"6"', False),
+])
+def test_etag_matches(header, matches):
+    assert etag_matches(header, list_etag(7)) is matches
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# CHANGE FEED TEST
+
+def test_change_log_backfills_and_keeps_tombstones(sqlite_engine):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE phonebook (id INTEGER PRIMARY KEY, full_name VARCHAR, phone_number VARCHAR)"))
+        conn.execute(text("INSERT INTO phonebook (full_name, phone_number) VALUES ('Bruce Schneier', '12345')"))
+        init_schema(conn)
+    # a second start doesn't log the rows again
+    with sqlite_engine.begin() as conn:
+        init_schema(conn)
+    with OrmSession(sqlite_engine) as session:
+        add_people(session, [("John Smith", "670-123-4567")])
+        delete_people(session, ["Bruce Schneier"], [])
+        session.commit()
+        changes = [(row.version, row.op, row.person_id, row.full_name) for row in fetch_changes(session, 0, 10)]
+        assert changes == [(1, "insert", 1, "Bruce Schneier"), (2, "insert", 2, "John Smith"), (3, "delete", 1, "Bruce Schneier")]
+        assert [row.version for row in fetch_changes(session, 1, 1)] == [2]
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# JSON ENCODING TEST
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_fast_json_same_bytes_without_orjson(monkeypatch, use_orjson):
+    content = {"items": [{"id": 1, "full_name": "O’Malley, John", "phone_number": "+1 (703) 111-2121"}], "next_cursor": None}
+    if not use_orjson:
+        monkeypatch.setattr(fastJson, "orjson", None)
+    assert fastJson.dumps(content) == '{"items":[{"id":1,"full_name":"O’Malley, John","phone_number":"+1 (703) 111-2121"}],"next_cursor":null}'.encode()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# METRICS AND PROFILER TEST
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test latency", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5.0, "/a")
+    assert histogram.render() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+    ]
+    assert histogram.count("/a") == 3
+    assert histogram.count("/b") == 0
+
+def test_counter_escapes_label_values():
+    counter = MetricCounter("test_total", "Test counter", ("route",))
+    counter.inc('/"quoted"')
+    counter.inc('/"quoted"', amount=2)
+    assert counter.render()[-1] == 'test_total{route="/\\"quoted\\""} 3'
+    assert counter.value('/"quoted"') == 3
+    assert counter.value("/other") == 0
+
+def test_profile_stages_are_exclusive():
+    assert requestProfiler.stage("database") is requestProfiler.stage("validator")
+    profile = requestProfiler.RequestProfile()
+    token = requestProfiler.current_profile.set(profile)
+    try:
+        with requestProfiler.stage("database"):
+            time.sleep(0.02)
+            with requestProfiler.stage("validator"):
+                time.sleep(0.05)
+    finally:
+        requestProfiler.current_profile.reset(token)
+    assert 0.05 <= profile.stages["validator"] < 0.07
+    assert 0.02 <= profile.stages["database"] < 0.04
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# WRITE PATH TEST
+
+def test_write_queue_commits_a_batch_with_results_per_write(phonebook_engine):
+    batches = []
+    write_queue = WriteQueue(sessionmaker(bind=phonebook_engine), window=0.2, on_batch=batches.append)
+
+    def failing_write(session):
+        session.execute(text("INSERT INTO phonebook (full_name, phone_number, phone_digits) VALUES ('Rolled Back', '12345', '12345')"))
+        raise ValueError("failed write")
+
+    futures = [
+        write_queue.submit(insert_person, "Bruce Schneier", "12345", "12345"),
+        write_queue.submit(insert_person, "Bruce Schneier", "12345", "12345"),
+        write_queue.submit(failing_write),
+        write_queue.submit(delete_first_person, PhoneBook.full_name, "Nobody Here"),
+        write_queue.submit(insert_person, "John Smith", "12345", "12345"),
+    ]
+    assert [future.result(5) for future in (futures[0], futures[1], futures[3], futures[4])] == [True, False, None, True]
+    with pytest.raises(ValueError):
+        futures[2].result(5)
+    write_queue.close()
+    assert batches == [5]
+    with phonebook_engine.connect() as conn:
+        assert conn.execute(text("SELECT full_name FROM phonebook ORDER BY id")).scalars().all() == ["Bruce Schneier", "John Smith"]
+
+def test_single_statement_writes(phonebook_engine):
+    statements = []
+    event.listen(phonebook_engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement.split()[0]))
+    with OrmSession(phonebook_engine) as session:
+        assert insert_person(session, "Bruce Schneier", "670-123-4567", "6701234567") is True
+        assert insert_person(session, "Bruce Schneier", "670.123.4567", "6701234567") is False
+        assert insert_person(session, "Bruce Schneier", "12345", "12345") is True
+        assert delete_first_person(session, PhoneBook.full_name, "Bruce Schneier") == ("Bruce Schneier", "670-123-4567")
+        assert delete_first_person(session, PhoneBook.phone_digits, "6701234567") is None
+        assert delete_first_person(session, PhoneBook.phone_digits, "12345") == ("Bruce Schneier", "12345")
+        session.commit()
+    assert statements == ["INSERT", "INSERT", "INSERT", "DELETE", "DELETE", "DELETE"]
+
+# A name and a number sharing their first row each delete a row of their own, however they are chunked
+@pytest.mark.parametrize("chunk", [500, 1])
+@pytest.mark.parametrize("all_matches, expected", [
+    (False, [(("name", "Bruce Schneier"), 1), (("number", "12345"), 3)]),
+    (True, [(("name", "Bruce Schneier"), 1), (("name", "Bruce Schneier"), 2), (("number", "12345"), 3), (("number", "12345"), 4)]),
+])
+def test_delete_people_gives_every_row_one_key(phonebook_engine, monkeypatch, chunk, all_matches, expected):
+    monkeypatch.setattr(main, "BULK_QUERY_CHUNK", chunk)
+    with OrmSession(phonebook_engine) as session:
+        add_people(session, [("Bruce Schneier", "12345"), ("Bruce Schneier", "670-123-4567"), ("John Smith", "12345"), ("Jane Doe", "12345")])
+        statements = []
+        event.listen(phonebook_engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement.split()[0]))
+        deleted = delete_people(session, ["Bruce Schneier"], ["12345"], all_matches=all_matches)
+        assert sorted((row.key, row.id) for row in deleted) == expected
+        # DELETE ... RETURNING only, per chunk with all_matches, per chunk of names and of numbers otherwise
+        assert statements == ["DELETE"] * (1 if all_matches and chunk > 1 else 2)
+        session.commit()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# BULK IMPORT TEST
+
+def import_into(engine):
+    def write_chunk(people):
+        with OrmSession(engine) as session:
+            results = add_people(session, people, validated=True)
+            session.commit()
+        return results
+    return write_chunk
+
+def test_bulk_import_resumes_from_checkpoint(tmp_path, phonebook_engine):
+    path = tmp_path / "contacts.csv"
+    path.write_text(
+        "full_name,phone_number\nBruce Schneier,12345\nL33t Hacker,12345\nJohn Smith,670-123-4567\n"
+        "broken\nJane Doe,(670) 123-4567\nJohn Smith,670.123.4567\n"
+    )
+    # stop after the first chunk, like a restart would
+    job = BulkImport(path, import_into(phonebook_engine), chunk_size=2, on_progress=lambda state: job.cancel())
+    assert job.run()["status"] == "interrupted"
+    assert (job.state["records"], job.state["added"], job.state["rejected"]) == (2, 1, 1)
+
+    job = BulkImport(path, import_into(phonebook_engine), chunk_size=2)
+    state = job.run()
+    assert state["status"] == "done"
+    assert (state["records"], state["added"], state["duplicates"], state["rejected"]) == (6, 3, 1, 3)
+    with open(job.rejects_path) as rejects:
+        assert [(row[0], row[3]) for row in csv.reader(rejects)] == [
+            ("record", "status"), ("2", "invalid_name"), ("4", "malformed"), ("6", "duplicate")]
+    with phonebook_engine.connect() as conn:
+        assert conn.execute(text("SELECT full_name FROM phonebook ORDER BY id")).scalars().all() == ["Bruce Schneier", "John Smith", "Jane Doe"]
+
+def test_bulk_import_validates_in_worker_processes(tmp_path, phonebook_engine):
+    path = tmp_path / "contacts.ndjson"
+    path.write_text("".join(
+        json.dumps({"full_name": f"Import Person {chr(65 + i % 26)}{chr(97 + i // 26)}", "phone_number": f"670 123 {i:04d}"}) + "\n"
+        for i in range(100)
+    ) + '{"full_name": "No Number"}\n')
+    state = BulkImport(path, import_into(phonebook_engine), chunk_size=10, workers=2, parallel_min_bytes=0).run()
+    assert (state["records"], state["added"], state["rejected"]) == (101, 100, 1)
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# SHARDED STORAGE TEST
+
+def test_shard_store_routes_by_number_and_maps_ids(tmp_path):
+    store = ShardStore([f"sqlite:///{tmp_path / f'shard-{shard}.db'}" for shard in range(4)], schema_engine)
+    try:
+        # crc32 of the digits, the same in every process
+        assert [store.shard_for(digits) for digits in ("12345", "6701234567", "5550100")] == [0, 2, 2]
+        assert {store.split_id(store.global_id(shard, local_id)) for shard in range(4) for local_id in (1, 2, 7)} == {
+            (shard, local_id) for shard in range(4) for local_id in (1, 2, 7)}
+        assert store.write_queues[0].submit(insert_person, "Bruce Schneier", "12345", "12345").result(5) is True
+        assert [store.run(shard, read_version) for shard in range(4)] == [1, 0, 0, 0]
+    finally:
+        store.close()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# PASSWORD POOL TEST
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("workers", [0, 1])
+async def test_password_pool_verifies(workers):
+    pool = PasswordPool(workers=workers)
+    hashed = get_pwd_context().hash("adminpassword")
+    try:
+        assert await pool.verify("adminpassword", hashed)
+        assert not await pool.verify("wrongpassword", hashed)
+    finally:
+        pool.shutdown()
+
+@pytest.mark.asyncio
+async def test_password_pool_rejects_when_full():
+    pool = PasswordPool(workers=0, max_pending=0)
+    with pytest.raises(PasswordPoolBusy):
+        await pool.verify("adminpassword", get_pwd_context().hash("adminpassword"))
+
+# A login whose caller gave up holds its slot until the hash is checked
+@pytest.mark.asyncio
+async def test_password_pool_counts_cancelled_logins(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(passwordPool, "verify_password", lambda plain, hashed: release.wait(5))
+    pool = PasswordPool(workers=0, max_pending=1)
+    try:
+        login = asyncio.ensure_future(pool.verify("adminpassword", "hash"))
+        await asyncio.sleep(0.05)
+        login.cancel()
+        with pytest.raises(PasswordPoolBusy):
+            await pool.verify("adminpassword", "hash")
+        release.set()
+        for _ in range(100):
+            if pool._pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert await pool.verify("adminpassword", "hash")
+    finally:
+        pool.shutdown()
+
+# A worker killed under the pool breaks it, the next login gets a new pool
+@pytest.mark.asyncio
+async def test_password_pool_replaces_broken_pool():
+    pool = PasswordPool(workers=1)
+    hashed = get_pwd_context().hash("adminpassword")
+    try:
+        assert await pool.verify("adminpassword", hashed)
+        broken = pool._executor
+        for process in list(broken._processes.values()):
+            process.kill()
+        assert await pool.verify("adminpassword", hashed)
+        assert pool._executor is not broken and pool._pending == 0
+    finally:
+        pool.shutdown()
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# USER STORE AND APP FACTORY TEST
+
+def test_user_store_loads_on_first_lookup(tmp_path):
+    path = tmp_path / "users.json"
+    store = UserStore(str(path))
+    path.write_text(json.dumps([{"username": "adminuser", "hashed_password": "x", "role": "read/write", "token": ""}]))
+    assert store.get("adminuser")["role"] == "read/write"
+    assert store.get("nobody") is None
+    path.write_text("[]")
+    assert store.get("adminuser") is not None
+    store.reload()
+    assert store.get("adminuser") is None
+
+def test_create_app_has_every_route():
+    paths = set(main.create_app().openapi()["paths"])
+    assert {"/token", "/PhoneBook/list", "/PhoneBook/add", "/PhoneBook/deleteByName", "/PhoneBook/deleteByNumber"} <= paths
+
+
+#########################################
+#########################################
+#########################################
+#########################################
+#########################################
+# AUDIT LOGGER TEST
+
+def test_audit_logger_keeps_line_format(tmp_path):
+    path = tmp_path / "audit.log"
+    logger = AuditLogger(str(path), flush_interval=60)
+    logger.log("ADD", "Added: Bruce Schneier, 12345")
+    logger.log("DELETE", "Deleted by name, details: Bruce Schneier,12345")
+    logger.flush()
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith(" - ADD: Added: Bruce Schneier, 12345")
+    assert lines[1].endswith(" - DELETE: Deleted by name, details: Bruce Schneier,12345")
+    logger.close()
+
+def test_audit_logger_json_format(tmp_path):
+    path = tmp_path / "audit.log"
+    logger = AuditLogger(str(path), json_format=True)
+    logger.log("LIST", "Listed phonebook entries")
+    logger.close()
+    record = json.loads(path.read_text())
+    assert record["action"] == "LIST"
+    assert record["details"] == "Listed phonebook entries"
+    assert "timestamp" in record
+
+def test_audit_logger_rotates(tmp_path):
+    path = tmp_path / "audit.log"
+    logger = AuditLogger(str(path), batch_size=1, max_bytes=200, backup_count=2)
+    for number in range(20):
+        logger.log("ADD", f"Added: John Doe, {number}")
+    logger.close()
+    assert path.exists()
+    assert (tmp_path / "audit.log.1").exists()
+    assert (tmp_path / "audit.log.2").exists()
+    assert not (tmp_path / "audit.log.3").exists()
+    assert path.stat().st_size <= 200
+
+def test_audit_logger_survives_write_errors(tmp_path):
+    lost = []
+    logger = AuditLogger(str(tmp_path / "missing" / "audit.log"), batch_size=1, queue_size=3, on_drop=lost.append)
+    started = time.monotonic()
+    for number in range(50):
+        logger.log("ADD", f"Added: John Doe, {number}")
+    logger.flush(timeout=2)
+    # the writer is still there, the records it couldn't write or queue are counted
+    assert logger._thread.is_alive()
+    assert logger.dropped == 50 and "No such file" in logger.last_error
+    assert sum(lost) == 50
+    (tmp_path / "missing").mkdir()
+    logger.log("ADD", "Added: Jane Doe, 1")
+    logger.close()
+    assert time.monotonic() - started < 2
+    assert (tmp_path / "missing" / "audit.log").read_text().endswith("ADD: Added: Jane Doe, 1\n")
+
+
 #########################################
 #########################################
 #########################################
@@ -86,7 +755,8 @@ async def test_list_phonebook(username, password, expected_status):
         headers = {"Authorization": f"Bearer {token}"}
         response = await client.get("/PhoneBook/list", headers=headers)
     assert response.status_code == expected_status
-    assert isinstance(response.json(), list), "Expected a list of phonebook entries"
+    assert isinstance(response.json()["items"], list), "Expected a list of phonebook entries"
+    assert "next_cursor" in response.json()
 
 # Test adding person with either admin or read only user
 @pytest.mark.asyncio
@@ -140,5 +810,26 @@ async def test_delete_person_by_phone_number(username, password, expected_status
     if expected_status == 200:
         assert response.json() == {"message": "Person deleted successfully"}
 
+# Tokens carry an expiry and are only verified once while they are valid
+@pytest.mark.asyncio
+async def test_token_is_cached():
+    token = await get_token("readonlyuser", "readonlypassword")
+    claims = jwt.get_unverified_claims(token)
+    assert claims["exp"] > time.time()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        headers = {"Authorization": f"Bearer {token}"}
+        before = (await client.get("/token/stats", headers=headers)).json()
+        await client.get("/PhoneBook/list", headers=headers)
+        after = (await client.get("/token/stats", headers=headers)).json()
+        response = await client.get("/PhoneBook/list", headers={"Authorization": f"Bearer {token}x"})
+    assert after["hits"] >= before["hits"] + 2
+    assert response.status_code == 401
 
-
+# A login over the pool's bound is refused right away
+@pytest.mark.asyncio
+async def test_login_when_password_pool_full(monkeypatch):
+    monkeypatch.setattr(main, "password_pool", PasswordPool(workers=0, max_pending=0))
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post("/token", data={"username": "adminuser", "password": "adminpassword"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
@@ -1,3 +1,5 @@
+import re
+
 ######################################
 #TEST CASES FROM REQUIREMENT
 valid_phones = [
@@ -189,4 +191,38 @@ invalid_names2 = [
 ]
 
 
-
+######################################
+#REFERENCE REGEXES
+#the checks the app ran before validator.py, its scanners must agree with them (test.py, validatorBench.py)
+
+phone_regex = re.compile(r"""
+    ^                                          # Start of string
+    ((\d{5}|                                   # 12345 
+        
+    \d{5}[-.\s]\d{5})|                         # 12345.12345
+        
+    (\d{3}[-.\s]\d{4})|                        # 123-4567
+        
+    (\+?[1-9]\d{0,2})?                      
+        (\s?\(?[1-9]\d{1,2}\)?[-.\s]?)     
+            (\d{3}[-.\s]\d{4})|                 
+        
+    ((\+?\d{1,3})[-.\s]\d{1,3}[-.\s]\d{3}[-.\s]\d{3}[-.\s]\d{4}$)|      # +1 234 567 8901
+    
+    (\d{4}[-.\s]\d{4})|                                                 # 1234 5678   
+                 
+    (\d{2}[-.\s]\d{2}[-.\s]\d{2}[-.\s]\d{2})|                           # 22 22 22 22
+    
+    ((\+?\d{1,3})[-.\s]\d{3}[-.\s]\d{3}[-.\s]\d{4})                     # +1 123 456 7890
+    )$""", re.VERBOSE)
+
+
+name_regex = re.compile(r"""
+    ^                                  
+    [a-zA-Z]([-'’\.])?[a-zA-Z]+?    
+                        
+    (([-'’\.])?,?\s[A-Z]([-'’\.])?[a-zA-Z]+(([\s -])?[A-Z][a-zA-Z]+)?)? 
+                 
+    (([-'’\.])?,?\s[A-Z]\.(\s[A-Z]([-'’\.])?[a-zA-Z]+(-[A-Z][a-zA-Z]+)?)?)?           
+    $                                  
+""", re.VERBOSE | re.UNICODE)
@@ -0,0 +1,27 @@
+import time
+from lruCache import LRUCache
+
+'''
+Verified-token cache
+Maps a bearer token that already passed jwt.decode to its resolved user,
+until the token's exp. Bounded, the least recently used token is dropped first.
+'''
+
+class TokenCache(LRUCache):
+    def __init__(self, max_size=10000):
+        super().__init__(max_size)
+
+    # entries are (expires_at, user)
+    def is_fresh(self, entry) -> bool:
+        return entry[0] > time.time()
+
+    # Cached user of the token, None when unknown or expired
+    def get(self, token):
+        entry = super().get(token)
+        return None if entry is None else entry[1]
+
+    # expires_at is the token's exp claim, in seconds since the epoch
+    def put(self, token, user, expires_at):
+        if expires_at <= time.time():
+            return
+        super().put(token, (expires_at, user))
@@ -0,0 +1,275 @@
+import re
+import unicodedata
+from itertools import product
+
+'''
+Validator engine
+phone_regex and name_regex (kept in testData.py as the reference the tests
+check against) rewritten as deterministic state machines. Every
+format is a flat sequence of character kinds with a repeat count, all formats
+are compiled together into one DFA when the module is imported, and a check is
+a single pass over the input with one table lookup per character: no
+backtracking, and inputs longer than the longest valid value are rejected
+before they are scanned. validate_name and validate_phone, at the end, are the
+checks the endpoints and the bulk import share.
+'''
+
+#########################################
+# FORMAT BUILDING BLOCKS
+
+# One element is (kinds, min, max), max None means unbounded
+def one(kinds):
+    return (frozenset(kinds), 1, 1)
+
+def repeat(kinds, low, high):
+    return (frozenset(kinds), low, high)
+
+# A pattern is a list of alternatives, each alternative a tuple of elements
+def seq(*parts):
+    alternatives = [()]
+    for part in parts:
+        options = part if isinstance(part, list) else [(part,)]
+        alternatives = [head + tail for head, tail in product(alternatives, options)]
+    return alternatives
+
+def optional(*parts):
+    return seq(*parts) + [()]
+
+def either(*patterns):
+    return list(dict.fromkeys(alternative for pattern in patterns for alternative in pattern))
+
+
+#########################################
+# STATE MACHINE
+
+class Scanner:
+    # kinds: number of character kinds, classify(ch) -> kind for any character
+    def __init__(self, pattern, kinds, classify, max_length=None):
+        self.kinds = kinds
+        self.classify = classify
+        # ASCII is looked up in a table, the rest goes through classify
+        self.ascii_kinds = [classify(chr(code)) for code in range(128)]
+        longest = max(sum(element[2] or 0 for element in alternative) for alternative in pattern)
+        # "$" also matches before one trailing newline, so one more character is allowed
+        self.max_length = max_length if max_length is not None else longest + 1
+        self._compile(pattern)
+
+    # NFA states are (alternative, element, count), closed over skipping finished elements
+    def _closure(self, pattern, states):
+        stack = list(states)
+        closed = set(states)
+        while stack:
+            alternative, index, count = stack.pop()
+            elements = pattern[alternative]
+            if index < len(elements) and count >= elements[index][1]:
+                skipped = (alternative, index + 1, 0)
+                if skipped not in closed:
+                    closed.add(skipped)
+                    stack.append(skipped)
+        return frozenset(closed)
+
+    def _advance(self, pattern, states, kind):
+        moved = set()
+        for alternative, index, count in states:
+            elements = pattern[alternative]
+            if index == len(elements):
+                continue
+            kinds, low, high = elements[index]
+            if kind not in kinds or (high is not None and count == high):
+                continue
+            # unbounded repeats stop counting once the minimum is reached
+            moved.add((alternative, index, count + 1 if high is not None or count < low else count))
+        return self._closure(pattern, moved)
+
+    # Subset construction over every kind, done once
+    def _compile(self, pattern):
+        start = self._closure(pattern, {(alternative, 0, 0) for alternative in range(len(pattern))})
+        numbers = {start: 0}
+        queue = [start]
+        self.table = []
+        self.accepting = []
+        while queue:
+            states = queue.pop(0)
+            row = []
+            for kind in range(self.kinds):
+                target = self._advance(pattern, states, kind)
+                if not target:
+                    row.append(-1)
+                    continue
+                if target not in numbers:
+                    numbers[target] = len(numbers)
+                    queue.append(target)
+                row.append(numbers[target])
+            self.table.append(row)
+            self.accepting.append(any(index == len(pattern[alternative]) for alternative, index, _ in states))
+
+    def _run(self, text, state=0):
+        table = self.table
+        ascii_kinds = self.ascii_kinds
+        classify = self.classify
+        for ch in text:
+            code = ord(ch)
+            state = table[state][ascii_kinds[code] if code < 128 else classify(ch)]
+            if state < 0:
+                return state
+        return state
+
+    # Same verdict as re.match(pattern + "$") on the whole text
+    def match(self, text) -> bool:
+        if len(text) > self.max_length:
+            return False
+        if not text.endswith("\n"):
+            state = self._run(text)
+            return state >= 0 and self.accepting[state]
+        state = self._run(text[:-1])
+        if state < 0:
+            return False
+        if self.accepting[state]:
+            return True
+        state = self._run("\n", state)
+        return state >= 0 and self.accepting[state]
+
+
+#########################################
+# PHONE NUMBERS, SAME FORMATS AS phone_regex
+
+ZERO, NONZERO, OTHER_DIGIT, PLUS, LEFT_PAREN, RIGHT_PAREN, DASH, DOT, SPACE, OTHER = range(10)
+
+def classify_phone_char(ch):
+    if "1" <= ch <= "9":
+        return NONZERO
+    if ch == "0":
+        return ZERO
+    if ch == "+":
+        return PLUS
+    if ch == "(":
+        return LEFT_PAREN
+    if ch == ")":
+        return RIGHT_PAREN
+    if ch == "-":
+        return DASH
+    if ch == ".":
+        return DOT
+    # \d and \s in a str pattern are any Unicode decimal digit and whitespace
+    if ch.isdecimal():
+        return OTHER_DIGIT
+    if ch.isspace():
+        return SPACE
+    return OTHER
+
+DIGIT = (ZERO, NONZERO, OTHER_DIGIT)
+SEPARATOR = (DASH, DOT, SPACE)
+
+PHONE_FORMATS = either(
+    # 12345, 12345.12345
+    seq(repeat(DIGIT, 5, 5)),
+    seq(repeat(DIGIT, 5, 5), one(SEPARATOR), repeat(DIGIT, 5, 5)),
+    # 123-4567
+    seq(repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 4, 4)),
+    # +1(703)111-2121, optional country code, area code with optional parentheses
+    seq(
+        optional(repeat([PLUS], 0, 1), one([NONZERO]), repeat(DIGIT, 0, 2)),
+        repeat([SPACE], 0, 1), repeat([LEFT_PAREN], 0, 1), one([NONZERO]), repeat(DIGIT, 1, 2),
+        repeat([RIGHT_PAREN], 0, 1), repeat(SEPARATOR, 0, 1),
+        repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 4, 4),
+    ),
+    # +1 234 567 8901
+    seq(
+        repeat([PLUS], 0, 1), repeat(DIGIT, 1, 3), one(SEPARATOR), repeat(DIGIT, 1, 3), one(SEPARATOR),
+        repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 4, 4),
+    ),
+    # 1234 5678
+    seq(repeat(DIGIT, 4, 4), one(SEPARATOR), repeat(DIGIT, 4, 4)),
+    # 22 22 22 22
+    seq(
+        repeat(DIGIT, 2, 2), one(SEPARATOR), repeat(DIGIT, 2, 2), one(SEPARATOR),
+        repeat(DIGIT, 2, 2), one(SEPARATOR), repeat(DIGIT, 2, 2),
+    ),
+    # +1 123 456 7890
+    seq(
+        repeat([PLUS], 0, 1), repeat(DIGIT, 1, 3), one(SEPARATOR),
+        repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 3, 3), one(SEPARATOR), repeat(DIGIT, 4, 4),
+    ),
+)
+
+phone_scanner = Scanner(PHONE_FORMATS, 10, classify_phone_char)
+
+
+#########################################
+# NAMES, SAME FORMATS AS name_regex
+
+UPPER, LOWER, NAME_DASH, APOSTROPHE, NAME_DOT, COMMA, NAME_SPACE, NAME_OTHER = range(8)
+
+def classify_name_char(ch):
+    if "A" <= ch <= "Z":
+        return UPPER
+    if "a" <= ch <= "z":
+        return LOWER
+    if ch == "-":
+        return NAME_DASH
+    if ch in "'’":
+        return APOSTROPHE
+    if ch == ".":
+        return NAME_DOT
+    if ch == ",":
+        return COMMA
+    if ch.isspace():
+        return NAME_SPACE
+    return NAME_OTHER
+
+LETTER = (UPPER, LOWER)
+PUNCTUATION = (NAME_DASH, APOSTROPHE, NAME_DOT)
+
+NAME_FORMATS = seq(
+    # Schneier, O’Malley
+    one(LETTER), repeat(PUNCTUATION, 0, 1), repeat(LETTER, 1, None),
+    # , Bruce Wayne
+    optional(
+        repeat(PUNCTUATION, 0, 1), repeat([COMMA], 0, 1), one([NAME_SPACE]), one([UPPER]),
+        repeat(PUNCTUATION, 0, 1), repeat(LETTER, 1, None),
+        optional(repeat([NAME_SPACE, NAME_DASH], 0, 1), one([UPPER]), repeat(LETTER, 1, None)),
+    ),
+    # , John F. or F. Kennedy-Smith
+    optional(
+        repeat(PUNCTUATION, 0, 1), repeat([COMMA], 0, 1), one([NAME_SPACE]), one([UPPER]), one([NAME_DOT]),
+        optional(
+            one([NAME_SPACE]), one([UPPER]), repeat(PUNCTUATION, 0, 1), repeat(LETTER, 1, None),
+            optional(one([NAME_DASH]), one([UPPER]), repeat(LETTER, 1, None)),
+        ),
+    ),
+)
+
+# validate_name caps names at 50 characters
+NAME_MAX_LENGTH = 50
+
+name_scanner = Scanner(NAME_FORMATS, 8, classify_name_char, max_length=NAME_MAX_LENGTH)
+
+
+#########################################
+# CHECKS, SHARED BY THE ENDPOINTS AND THE BULK IMPORT
+
+# Longest phone number, in digits
+PHONE_MAX_DIGITS = 15
+
+# Everything that is not a digit, stripped to get the normalized phone number
+non_digit_regex = re.compile(r'[^0-9]')
+
+# Digits only form of a phone number, "670-123-4567" and "670.123.4567" are the same number.
+# phone_scanner takes any Unicode digit like \d does, "٣٣٣-٣٣٣٣" and "３３３-３３３３" are 3333333 too
+def normalize_phone(phone) -> str:
+    if phone.isascii():
+        return non_digit_regex.sub('', phone)
+    return "".join(str(unicodedata.decimal(ch)) for ch in phone if ch.isdecimal())
+
+# Validate name, need to verify only, leave the exception for endpoint.
+# name_scanner accepts exactly what name_regex does, in one pass,
+# and rejects names over 50 characters before scanning them
+def validate_name(name) -> bool:
+    return name_scanner.match(name)
+
+# Validate phone, need to verify only, leave the exception for endpoint.
+# phone_scanner accepts exactly what phone_regex does, too long inputs are rejected first
+def validate_phone(phone) -> bool:
+    if not phone_scanner.match(phone):
+        return False
+    return len(normalize_phone(phone)) <= PHONE_MAX_DIGITS
@@ -0,0 +1,67 @@
+import re
+import sys
+import json
+import timeit
+from validator import validate_phone, validate_name
+from testData import phone_regex, name_regex
+
+'''
+Adversarial-input benchmark for validate_phone and validate_name
+compares the regex checks they used to run with the validator.py scanners
+run: `python validatorBench.py [repeats]`, prints JSON with microseconds per call
+'''
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+# Inputs that get far into the patterns before failing, at every size
+PHONE_INPUTS = {
+    "digits": lambda n: "1" * n,
+    "digit_separator": lambda n: "1-" * (n // 2),
+    "country_code_area": lambda n: "+1 (" + "2" * n,
+    "parentheses": lambda n: "(" * n,
+    "unicode_digits": lambda n: "٣" * n,
+    "groups_then_letter": lambda n: "22 " * (n // 3) + "x",
+}
+NAME_INPUTS = {
+    "letters": lambda n: "a" * n,
+    "words": lambda n: "A" + " Ab" * (n // 3),
+    "punctuated_then_digit": lambda n: "Ab-" * (n // 3) + "1",
+    "initials": lambda n: "Ab" + ", A." * (n // 4),
+}
+
+# What validate_phone and validate_name ran before the scanners
+def regex_validate_phone(phone) -> bool:
+    cleaned_phone = re.sub(r'[^0-9]', '', phone)
+    if not phone_regex.match(phone):
+        return False
+    return len(cleaned_phone) <= 15
+
+def regex_validate_name(name) -> bool:
+    if not name_regex.match(name):
+        return False
+    return len(name) <= 50
+
+def per_call_us(check, value, repeats):
+    return round(min(timeit.repeat(lambda: check(value), number=repeats, repeat=3)) / repeats * 1e6, 3)
+
+def run(repeats=200):
+    results = []
+    for kind, inputs, old, new in [
+        ("phone", PHONE_INPUTS, regex_validate_phone, validate_phone),
+        ("name", NAME_INPUTS, regex_validate_name, validate_name),
+    ]:
+        for name, build in inputs.items():
+            for size in SIZES:
+                value = build(size)
+                assert old(value) == new(value)
+                results.append({
+                    "validator": kind,
+                    "input": name,
+                    "length": len(value),
+                    "regex_us": per_call_us(old, value, repeats),
+                    "scanner_us": per_call_us(new, value, repeats),
+                })
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200), indent=2))
@@ -0,0 +1,131 @@
+import time
+import queue
+import atexit
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future
+
+'''
+Single-writer queue with group commit
+Write operations, fn(session, *args) like the ones given to run_db, are
+queued to one writer thread. It takes everything queued, waits up to window
+seconds for more, then runs the batch in one transaction with a SAVEPOINT per
+operation and commits once. A failing operation only rolls back its own
+savepoint, every caller gets its own result or exception after the commit.
+On SQLite the transaction starts with BEGIN IMMEDIATE, so the write lock is
+taken up front (waiting up to busy_timeout) instead of failing on upgrade.
+One writer runs per process: several uvicorn workers still share the SQLite
+lock, but take it once per batch instead of once per request.
+'''
+
+class WriteQueue:
+    def __init__(self, session_factory, window=0.002, max_batch=128, on_batch=None):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        # called with the size of every committed batch, from the writer thread
+        self.on_batch = on_batch
+        # committed batches and the operations in them
+        self.batches = 0
+        self.operations = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    # Queue fn(session, *args), the future is set once its batch is committed
+    def submit(self, fn, *args) -> Future:
+        self._start()
+        future = Future()
+        # the writer runs fn in the caller's context, so request metrics and profiles see it
+        self._queue.put((fn, args, future, contextvars.copy_context()))
+        return future
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    # Commit what is queued and stop the writer thread
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+                self._thread.start()
+
+    # Everything already queued, then whatever arrives within the window, up to max_batch
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                # close, stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            session = self.session_factory()
+        except Exception as e:
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+        try:
+            if session.get_bind().dialect.name == "sqlite":
+                session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for fn, args, future, context in batch:
+                savepoint = session.begin_nested()
+                try:
+                    result = context.run(fn, session, *args)
+                    savepoint.commit()
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    savepoint.rollback()
+                    outcomes.append((future, None, e))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+        finally:
+            session.close()
+        self.batches += 1
+        self.operations += len(batch)
+        if self.on_batch is not None:
+            self.on_batch(len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)